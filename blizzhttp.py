@@ -0,0 +1,319 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" The HTTP client shared by everything that talks to the Blizzard API.
+    Connections are pooled and kept alive so that repeated small lookups do not pay
+    for a new TCP and TLS handshake each time, responses are gzip compressed and
+    failed requests are retried. Stored responses are revalidated with conditional requests.
+    Every GET takes a token from the RateLimiter shared by all processes, and while
+    blizzard is failing a CircuitBreaker fails calls at once instead of waiting on them.
+"""
+
+import os,logging,asyncio,time,threading
+import configparser
+import requests
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from overlordauth import OverlordAuthDb
+from ratelimit import RateLimiter,INTERACTIVE,BACKGROUND
+
+log = logging.getLogger('blizzhttp')
+
+_clients = {}
+
+def client(config_file='discord_simc.conf'):
+    """ Returns the client shared by the process for the config file.
+    """
+    if config_file not in _clients.keys():
+        _clients[config_file] = BlizzardClient(config_file)
+    return _clients[config_file]
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling blizzard while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker(object):
+    """ Opens after threshold consecutive failed calls, connection errors, timeouts,
+        5xx and 429 responses. While open every call fails at once with CircuitOpenError
+        and a background thread runs the probe every cooldown seconds, closing the
+        circuit as soon as a probe succeeds.
+    """
+
+    def __init__(self, threshold, cooldown, probe):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._probe = probe
+        self._failures = 0
+        self._open = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self._open
+
+    def check(self):
+        if self._open:
+            raise CircuitOpenError('The Blizzard API is unavailable, try again later')
+
+    def record(self, status):
+        if status >= 500 or status == 429:
+            self.failure()
+        else:
+            self.success()
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._open or self._failures < self._threshold:
+                return
+            self._open = True
+        log.warning('circuit open after {} failures'.format(self._failures))
+        threading.Thread(target=self.recover, name='CircuitBreaker-probe', daemon=True).start()
+
+    def recover(self):
+        while True:
+            time.sleep(self._cooldown)
+            try:
+                self._probe()
+            except Exception as e:
+                log.warning('probe failed, circuit stays open')
+                log.warning(str(e))
+                continue
+            with self._lock:
+                self._failures = 0
+                self._open = False
+            log.info('probe succeeded, circuit closed')
+            return
+
+
+class BlizzardClient(object):
+    """ A keep-alive connection pool for the Blizzard API, with a requests session for
+        blocking callers and an aiohttp session for coroutines. The bearer token is
+        added to every request.
+    """
+
+    # responses retried by both sessions, waiting BACKOFF * 2^n seconds between attempts
+    RETRY_STATUS = [500, 502, 503, 504]
+    BACKOFF = 0.5
+
+    # a cheap game data document fetched to find out whether blizzard has recovered
+    PROBE_URL = 'https://us.api.blizzard.com/data/wow/realm/index?locale=en_US'
+
+    def __init__(self, config_file):
+        self._timeout = 10
+        self._retries = 2
+        self._pool_size = 10
+        self._breaker_threshold = 5
+        self._breaker_cooldown = 30
+        if os.path.isfile(config_file):
+            self.parse_config(config_file)
+
+        self._auth = OverlordAuthDb(config_file)
+        self._limiter = RateLimiter(config_file)
+        self._breaker = CircuitBreaker(self._breaker_threshold, self._breaker_cooldown, self.probe)
+
+        retry = Retry(total=self._retries, backoff_factor=self.BACKOFF, status_forcelist=self.RETRY_STATUS)
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('https://', self._adapter)
+        self._session.headers.update({ 'Accept-Encoding' : 'gzip' })
+
+        self._async_session = None
+        self._async_requests = 0
+        self._async_connections = 0
+        self._not_modified = 0
+
+    def headers(self, namespace=None, headers=None):
+        token = self._auth.load_token()
+        result = { 'Authorization' : "Bearer {}".format(token['access_token']) }
+        if namespace != None:
+            result['Battlenet-Namespace'] = namespace
+        if headers != None:
+            result.update(headers)
+        return result
+
+    def available(self):
+        """ Returns False while the circuit breaker is open and calls would fail at once.
+        """
+        return not self._breaker.is_open()
+
+    def probe(self):
+        self._limiter.acquire(BACKGROUND)
+        response = self._session.get(self.PROBE_URL, headers=self.headers('dynamic-us'), timeout=self._timeout)
+        response.raise_for_status()
+
+    def send(self, url, namespace, headers, priority):
+        """ An authorized GET through the circuit breaker and rate limiter, the status is
+            recorded with the breaker but not raised.
+        """
+        log.debug('GET {}'.format(url))
+        self._breaker.check()
+        self._limiter.acquire(priority)
+        try:
+            response = self._session.get(url, headers=self.headers(namespace, headers), timeout=self._timeout)
+        except requests.RequestException:
+            self._breaker.failure()
+            raise
+        self._breaker.record(response.status_code)
+        return response
+
+    def get(self, url, namespace=None, headers=None, priority=INTERACTIVE):
+        """ Performs an authorized GET, raising for error responses.
+
+        :param int priority: INTERACTIVE or BACKGROUND for the rate limiter
+        :return: the requests.Response
+        """
+        response = self.send(url, namespace, headers, priority)
+        response.raise_for_status()
+        return response
+
+    def post(self, url, payload, headers=None):
+        """ Performs an unauthorized POST of a json body, used for webhooks. A 429 Too
+            Many Requests is returned rather than raised so the caller can wait and retry.
+        """
+        log.debug('POST {}'.format(url))
+        response = self._session.post(url, json=payload, headers=headers, timeout=self._timeout)
+        if response.status_code != 429:
+            response.raise_for_status()
+        return response
+
+    async def post_async(self, url, payload, headers=None):
+        """ Coroutine version of post.
+
+        :return: the status, response headers and body text
+        """
+        log.debug('POST {}'.format(url))
+        attempt = 0
+        while True:
+            try:
+                async with self.async_session().post(url, json=payload, headers=headers) as response:
+                    if response.status != 429:
+                        response.raise_for_status()
+                    text = await response.text()
+                    return response.status, response.headers, text
+            except aiohttp.ClientConnectorError:
+                # like the requests session a POST is only retried when it was never sent
+                if attempt >= self._retries:
+                    raise
+            attempt = await self.backoff(attempt, url)
+
+    async def get_async(self, url, namespace=None, headers=None, priority=INTERACTIVE):
+        """ Performs an authorized GET on the shared aiohttp session, raising for error responses.
+
+        :return: the status, response headers and body text
+        """
+        log.debug('GET {}'.format(url))
+        self._breaker.check()
+        loop = asyncio.get_event_loop()
+        request_headers = await loop.run_in_executor(None, self.headers, namespace, headers)
+        attempt = 0
+        while True:
+            await self._limiter.acquire_async(priority)
+            try:
+                async with self.async_session().get(url, headers=request_headers) as response:
+                    if response.status not in self.RETRY_STATUS or attempt >= self._retries:
+                        self._breaker.record(response.status)
+                        response.raise_for_status()
+                        text = await response.text()
+                        return response.status, response.headers, text
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self._retries:
+                    self._breaker.failure()
+                    raise
+            attempt = await self.backoff(attempt, url)
+
+    async def backoff(self, attempt, url):
+        """ Waits before retrying a failed request and returns the next attempt number.
+        """
+        delay = self.BACKOFF * 2 ** attempt
+        log.debug('retrying {} in {}s'.format(url, delay))
+        await asyncio.sleep(delay)
+        return attempt + 1
+
+    def get_conditional(self, url, validators, namespace=None, priority=INTERACTIVE):
+        """ An authorized GET sending the ETag and Last-Modified validators of a previous
+            response, if any, so that blizzard can answer 304 Not Modified.
+
+        :return: the status, response headers and body text
+        """
+        response = self.send(url, namespace, self.conditional_headers(validators), priority)
+        if response.status_code == 304 and validators != None:
+            self._not_modified += 1
+            return response.status_code, response.headers, None
+        response.raise_for_status()
+        return response.status_code, response.headers, response.text
+
+    async def get_conditional_async(self, url, validators, namespace=None, priority=INTERACTIVE):
+        """ Coroutine version of get_conditional.
+        """
+        status, headers, text = await self.get_async(url, namespace, self.conditional_headers(validators), priority)
+        if status == 304 and validators != None:
+            self._not_modified += 1
+            return status, headers, None
+        return status, headers, text
+
+    def conditional_headers(self, validators):
+        headers = {}
+        if validators != None:
+            if validators.get('ETag') != None:
+                headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified') != None:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+        return headers
+
+    def async_session(self):
+        if self._async_session == None or self._async_session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self.on_request_start)
+            trace.on_connection_create_end.append(self.on_connection_create_end)
+            connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60)
+            self._async_session = aiohttp.ClientSession(connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self._timeout), trace_configs=[trace])
+        return self._async_session
+
+    async def on_request_start(self, session, context, params):
+        self._async_requests += 1
+
+    async def on_connection_create_end(self, session, context, params):
+        self._async_connections += 1
+
+    def metrics(self):
+        """ Returns the number of requests made and connections opened by both sessions,
+            requests - connections is the number of times a connection was reused, and
+            the number of revalidations answered with 304 Not Modified.
+        """
+        requests = self._async_requests
+        connections = self._async_connections
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests += pool.num_requests
+            connections += pool.num_connections
+        return {
+            "requests" : requests,
+            "connections" : connections,
+            "reused" : requests - connections,
+            "not_modified" : self._not_modified,
+        }
+
+    def parse_config(self, file):
+        """ Read the local configuration from the file specified.
+
+        """
+        log.debug("parsing config file: {}".format(file))
+        config = configparser.ConfigParser()
+        config.read(file)
+        if config.has_section('http'):
+            self._timeout = config['http'].getint('timeout', self._timeout)
+            self._retries = config['http'].getint('retries', self._retries)
+            self._pool_size = config['http'].getint('pool_size', self._pool_size)
+            self._breaker_threshold = config['http'].getint('breaker_threshold', self._breaker_threshold)
+            self._breaker_cooldown = config['http'].getint('breaker_cooldown', self._breaker_cooldown)
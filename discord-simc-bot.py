@@ -25,6 +25,7 @@ port = config['rabbitmq']['port']
 exchange = config['simcdaemon']['exchange']
 simc_request_routing_key = config['simcdaemon']['request_routing_key']
 simc_response_routing_key = config['simcdaemon']['response_routing_key']
+simc_progress_routing_key = config['simcdaemon'].get('progress_routing_key', 'simc.progress')
 mounts_request_routing_key = config['mounts']['request_routing_key']
 mounts_response_routing_key = config['mounts']['response_routing_key']
 token = config['discord']['bot_token']
@@ -55,8 +56,12 @@ async def on_message(message):
 !sim <character> [[realm] [movement:none|light|heavy]] (realm is Khaz'goroth by default)
     e.g. !sim vengel khazgoroth light
 
-!mounts <character> [realm] (realm is Khaz'goroth by default)
-    Minimum time between updates is 10mins, cached results are returned for less than 10mins
+!mounts <character> [realm] [new] (realm is Khaz'goroth by default)
+    new lists the mounts new since the bot last saw the character, within the last week
+    Results up to 10mins old are returned at once and refreshed in the background
+
+!mounts guild <guild> (guild is a key from the guilds config)
+    A leaderboard of the mount collections of the guild members
 
 """
         await message.channel.send(helpmsg)
@@ -82,21 +87,26 @@ async def on_message(message):
                     'delivery_mode':2, },
                 payload=json.dumps(payload))
 
-        await message.channel.send('Queued mounts check for {}'.format(payload["character"]))
+        if "guild" in payload.keys():
+            await message.channel.send('Queued mounts leaderboard for {}'.format(payload["guild"]))
+        else:
+            await message.channel.send('Queued mounts check for {}'.format(payload["character"]))
 
     if content.startswith(simc.cmd()):
         payload = simc.create_payload_from_msg(str(message.content))
-            
+
+        # progress updates edit this message in place
+        queued = await message.channel.send( 'Queued simulation of {}'.format(payload["character"]))
+
         await client.mqchannel.basic_publish(
                 exchange_name=exchange,
                 routing_key=simc_request_routing_key,
                 properties={
                     'reply_to' : str(message.channel.id),
+                    'correlation_id' : str(queued.id),
                     'delivery_mode':2, },
                 payload=json.dumps(payload))
 
-        await message.channel.send( 'Queued simulation of {}'.format(payload["character"]))
-
 
 @client.event
 async def on_ready():
@@ -243,6 +253,17 @@ async def callback(channel, body, envelope, properties):
         else:
             await xchannel.send(result["response"])
 
+    elif envelope.routing_key == simc_progress_routing_key:
+        await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+        state = json.loads(body.decode('utf-8'))
+        try:
+            queued = await xchannel.fetch_message(int(properties.correlation_id))
+            await queued.edit(content='Simulating {}: {} {}%'.format(
+                state["character"], state["phase"], state["percent"]))
+        except Exception as e:
+            logging.warning('Unable to update progress message {}'.format(properties.correlation_id))
+            logging.warning(str(e))
+
     elif envelope.routing_key == mounts_response_routing_key:
         await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
         result = json.loads(body.decode('utf-8'))
@@ -270,6 +291,7 @@ async def receive_simc(loop):
     result = await r_channel.queue(queue_name='', durable=True, auto_delete=True)
     r_queue_name = result['queue']
     await r_channel.queue_bind( exchange_name=exchange, queue_name=r_queue_name, routing_key=simc_response_routing_key)
+    await r_channel.queue_bind( exchange_name=exchange, queue_name=r_queue_name, routing_key=simc_progress_routing_key)
     await r_channel.queue_bind( exchange_name=exchange, queue_name=r_queue_name, routing_key=mounts_response_routing_key)
 
     logging.info("simc response consumer listening")
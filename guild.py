@@ -4,45 +4,66 @@
 # Author: T'lexii (tlexii@gmail.com)
 #
 """ A class to poll blizzard api for guild news - probably be sent to discord as webhook.
+    Runs once from cron, or with --service as a long running poller of every guild.
 """
 
-import os,time,logging,argparse,json,re,datetime
-from urllib.request import Request,urlopen
+import os,time,logging,argparse,json,re,datetime,asyncio,random
 from urllib import parse
 import configparser
+import blizzhttp
 from overlordauth import OverlordAuthDb
+from newsstore import NewsStore
 
 log = logging.getLogger('guild')
 
+def read_guilds(config):
+    """ Returns the config section of each guild listed in [warcraft] guilds, by guild key.
+    """
+    guilds = {}
+    for gkey in re.compile(r',').split(config['warcraft']['guilds'].strip()):
+        guildkey = gkey.strip()
+        guilds[guildkey] = config[guildkey]
+    return guilds
+
+def realm_slug(realm):
+    """ Returns the blizzard slug of a realm name, Khaz'goroth is khazgoroth.
+    """
+    return realm.lower().replace(' ', '-').replace("'", '')
+
+def roster_url(realm, name):
+    """ Returns the profile api url of the guilds roster, the realm and guild name are slugified.
+    """
+    return 'https://us.api.blizzard.com/data/wow/guild/{}/{}/roster?locale=en_US'.format(
+        parse.quote(realm_slug(realm)), parse.quote(name.lower().replace(' ', '-')))
+
 class GuildNews(object):
-    """ Polls the Blizzard API for Guild News, maintains the timestamp internally
+    """ Polls the Blizzard API for Guild News, the items already announced are kept in a NewsStore
     """
 
     FORMAT = "%Y-%m-%d %H:%M:%S"
 
+    # discord accepts at most 10 embeds and 2000 characters of content per message
+    MAX_EMBEDS = 10
+    MAX_CONTENT = 2000
+
+    WEBHOOK_HEADERS = {
+        'User-Agent' : 'discord-webhook (1.0)',
+        'Accept' : 'application/json',
+    }
+
     def __init__(self, config_file):
 
+        self._config_file = config_file
+        self._min_interval = 60
+        self._max_interval = 900
+        self._webhooks = {}
         if os.path.isfile(config_file):
             self.parse_config(config_file)
         else:
             self._guilds = {}
-            self._run_dir = '/var/run/warcraft'
-
-        self._auth = OverlordAuthDb(config_file)
 
-    def read_run_file(self, guildkey):
-        try:
-            f=open(self._guilds[guildkey]['runfile'], "rt")
-            self._timestamp=int(f.read())
-            f.close()
-            return True
-        except Exception:
-            return False
-
-    def write_run_file(self, guildkey):
-        f=open(self._guilds[guildkey]['runfile'], "wt")
-        f.write(str(self._timestamp))
-        f.close()
+        self._http = blizzhttp.client(config_file)
+        self._news = NewsStore(config_file)
 
     def run(self):
         """ Loops over all the keys in the configuration
@@ -53,12 +74,111 @@ class GuildNews(object):
             log.debug(str(result))
             if 'news_items' in result.keys() and len(result['news_items']) > 0:
                 self.announce(self._guilds[guildkey], result)
-                    
-            time.sleep(1)
-        log.info('END Polling guilds')
+        log.info('END Polling guilds {}'.format(str(self._http.metrics())))
+
+    async def serve(self):
+        """ Service mode, polls every guild concurrently on one event loop until cancelled.
+            The token is renewed in the background and connections stay open between polls.
+        """
+        log.info('Serving {} guilds'.format(len(self._guilds)))
+        OverlordAuthDb(self._config_file).start_refresher()
+        results = await asyncio.gather(*[ self.poll_guild(guildkey) for guildkey in self._guilds.keys() ],
+            return_exceptions=True)
+        for guildkey, result in zip(self._guilds.keys(), results):
+            log.error('Polling {} stopped: {}'.format(guildkey, str(result)))
+
+    async def poll_guild(self, guildkey):
+        """ Polls one guild forever. The interval drops to poll_min_interval whenever the
+            guilds lastModified changes and doubles, up to poll_max_interval, while it doesn't.
+        """
+        interval = self._min_interval
+        last_modified = None
+        # spread the guilds over the first interval
+        await asyncio.sleep(random.uniform(0, self._min_interval))
+        while True:
+            # one bad poll, a missing webhook or a malformed news item, must not end the loop
+            try:
+                result = await self.run_guild_async(guildkey)
+                log.debug(str(result))
+                if 'news_items' in result.keys() and len(result['news_items']) > 0:
+                    self.enqueue(self._guilds[guildkey], result)
+
+                if 'last_modified' in result.keys() and result['last_modified'] != last_modified:
+                    interval = self._min_interval
+                    last_modified = result['last_modified']
+                else:
+                    interval = min(interval * 2, self._max_interval)
+            except Exception as e:
+                log.error('Exception polling {}'.format(guildkey))
+                log.error(str(e))
+                interval = min(interval * 2, self._max_interval)
+            log.debug('next poll of {} in {}s'.format(guildkey, interval))
+            await asyncio.sleep(interval)
 
     def announce(self, guild, result):
+        """ Sends the news to the guilds webhook, paced by discords rate limit headers.
+        """
         log.debug('sending updates to : {}'.format(guild['webhook']))
+        for msg in self.messages(result):
+            while True:
+                response = self._http.post(guild['webhook'], msg, headers=self.WEBHOOK_HEADERS)
+                delay, retry = self.rate_limit(response.status_code, response.headers, response.text)
+                if delay > 0:
+                    time.sleep(delay)
+                if not retry:
+                    break
+
+    def enqueue(self, guild, result):
+        """ Queues the news for the guilds webhook, each webhook has its own queue and
+            sender so a busy or rate limited webhook never delays the others.
+        """
+        webhook = guild['webhook']
+        if webhook not in self._webhooks.keys():
+            self._webhooks[webhook] = asyncio.Queue()
+            asyncio.ensure_future(self.deliver(webhook, self._webhooks[webhook]))
+        for msg in self.messages(result):
+            self._webhooks[webhook].put_nowait(msg)
+
+    async def deliver(self, webhook, queue):
+        """ Sends the queued messages for one webhook forever.
+        """
+        while True:
+            msg = await queue.get()
+            try:
+                while True:
+                    status, headers, text = await self._http.post_async(webhook, msg, headers=self.WEBHOOK_HEADERS)
+                    delay, retry = self.rate_limit(status, headers, text)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if not retry:
+                        break
+            except Exception as e:
+                log.error('Exception sending to webhook')
+                log.error(str(e))
+
+    def rate_limit(self, status, headers, text):
+        """ Returns how long to wait before the next message to the webhook and whether
+            the message has to be sent again after a 429.
+        """
+        if status == 429:
+            delay = headers.get('Retry-After')
+            if delay == None:
+                try:
+                    delay = json.loads(text).get('retry_after')
+                except ValueError:
+                    pass
+            log.warning('webhook rate limited, retrying in {}s'.format(delay))
+            return float(delay or 1), True
+        if headers.get('X-RateLimit-Remaining') == '0':
+            return float(headers.get('X-RateLimit-Reset-After', 1)), False
+        return 0, False
+
+    def messages(self, result):
+        """ Packs the news into webhook messages of up to MAX_EMBEDS embeds each, with
+            the announcement lines as the content.
+        """
+        messages = []
+        msg = None
         for ach in result['news_items']:
             if ach['type'] == 'playerAchievement':
                 line = '**{}** earned achievement **{}** for {} points'.format(
@@ -70,47 +190,56 @@ class GuildNews(object):
                     result['output_guild'], 
                     ach['achievement']['title'], 
                     ach['achievement']['points'])
-            msg = {
-                'content' : line,
-                'embeds' : [{
-                    'title' : ach['achievement']['title'],
-                    'url' : "http://www.wowhead.com/achievement={}".format(ach['achievement']['id']),
-                    'description' : ach['achievement']['description'],
-                    'type' : 'link',
-                    'thumbnail' : {
-                        'url' :  "http://wow.zamimg.com/images/wow/icons/large/{}.jpg".format(ach['achievement']['icon'])
-                    }
-                }]
+            embed = {
+                'title' : ach['achievement']['title'],
+                'url' : "http://www.wowhead.com/achievement={}".format(ach['achievement']['id']),
+                'description' : ach['achievement']['description'],
+                'type' : 'link',
+                'thumbnail' : {
+                    'url' :  "http://wow.zamimg.com/images/wow/icons/large/{}.jpg".format(ach['achievement']['icon'])
+                }
             }
             log.info('{}: {}'.format(datetime.datetime.fromtimestamp(ach['timestamp']/1000).strftime(self.FORMAT), line))
-            req = Request(guild['webhook'])
-            req.add_header('User-Agent', 'discord-webhook (1.0)')
-            req.add_header('Accept', 'application/json')
-            req.add_header('Content-Type', 'application/json; charset=utf-8')
-            jsondata = json.dumps(msg)
-            jsondataasbytes = jsondata.encode('utf-8')   # needs to be bytes
-            req.add_header('Content-Length', len(jsondataasbytes))
-            response = urlopen(req, jsondataasbytes).read()
-            time.sleep(1)
+            if (msg == None or len(msg['embeds']) == self.MAX_EMBEDS
+                    or len(msg['content']) + len(line) + 1 > self.MAX_CONTENT):
+                msg = { 'content' : line, 'embeds' : [ embed ] }
+                messages.append(msg)
+            else:
+                msg['content'] += '\n' + line
+                msg['embeds'].append(embed)
+        return messages
 
     def run_guild(self, guildkey):
         """ Contact endpoint for each guilds data update
 
         """
         log.info('GUILD key {}'.format(guildkey))
-        params = {}
         try:
-            # read the timestamp for the guilds runfile
-            if not self.read_run_file(guildkey):
-                # Blizzard send timestamp as milliseconds, make ours compatible
-                self._timestamp=int(time.mktime(time.localtime()))*1000
-                self.write_run_file(guildkey)
-
-            self.log_time('Last processed', self._timestamp)
-
             guildjson = self.read_data(guildkey)
             #guildjson = self.read_debug(guildkey)
+        except Exception as e:
+            log.error('Exception executing request')
+            log.error(str(e))
+            return {}
+        return self.parse_news(guildkey, guildjson)
+
+    async def run_guild_async(self, guildkey):
+        """ Coroutine version of run_guild using the shared connection pool.
+        """
+        log.info('GUILD key {}'.format(guildkey))
+        try:
+            status, headers, guildjson = await self._http.get_async(self.news_url(guildkey), priority=blizzhttp.BACKGROUND)
+        except Exception as e:
+            log.error('Exception executing request')
+            log.error(str(e))
+            return {}
+        return await asyncio.get_event_loop().run_in_executor(None, self.parse_news, guildkey, guildjson)
 
+    def parse_news(self, guildkey, guildjson):
+        """ Selects the achievements that have not been announced yet.
+        """
+        params = {}
+        try:
             if guildjson == None:
                 log.error('No data returned')
 
@@ -124,40 +253,23 @@ class GuildNews(object):
             else:
                 params["colour"] = 0xFF1111
 
-            params["news_items"] = list(filter(
-                lambda x : (x["type"] == 'guildAchievement'
-                        or x["type"] == 'playerAchievement')
-                    and x["timestamp"] > self._timestamp
-                , guild["news"]))
+            params["news_items"] = self._news.select_new(guildkey, [ x for x in guild["news"]
+                if x["type"] == 'guildAchievement' or x["type"] == 'playerAchievement' ])
+            log.info('{} new items'.format(len(params["news_items"])))
 
-            #self._timestamp=guild["lastModified"]
-            if len(guild["news"]) > 0:
-                # maintain our timestamp to match blizzard's last event, not their last modified or our time
-                self._timestamp= guild["news"][0]["timestamp"]
-            else:
-                # use current time
-                self._timestamp=int(time.mktime(time.localtime()))*1000
-            
-            self.log_time('Saving lastEvent',self._timestamp)
-            self.write_run_file(guildkey)
-                
         except Exception as e:
             log.error('Exception executing request')
             log.error(str(e))
 
         return params
 
-    def read_data(self, guildkey):
-        self._auth.load_token()
-        url='https://us.api.blizzard.com/wow/guild/{}/{}?fields=news&locale=en_US'.format(
+    def news_url(self, guildkey):
+        return 'https://us.api.blizzard.com/wow/guild/{}/{}?fields=news&locale=en_US'.format(
             parse.quote(self._guilds[guildkey]['realm']),
             parse.quote(self._guilds[guildkey]['name']))
-        req = Request(url)
-        req.add_header('Authorization', "Bearer {}".format(self._auth.get_token()['access_token']))
-        f=urlopen(req)
-        guildjson=f.read().decode('utf-8')
-        f.close()
-        return guildjson
+
+    def read_data(self, guildkey):
+        return self._http.get(self.news_url(guildkey), priority=blizzhttp.BACKGROUND).text
 
     def read_debug(self, guildkey):
         f=open('guild_news.json',"rt")
@@ -177,15 +289,10 @@ class GuildNews(object):
         log.debug("parsing config file: {}".format(file))
         config = configparser.ConfigParser()
         config.read(file)
-        self._run_dir = config['warcraft']['run_dir']
-        self._guilds = {}
+        self._min_interval = config['warcraft'].getint('poll_min_interval', self._min_interval)
+        self._max_interval = config['warcraft'].getint('poll_max_interval', self._max_interval)
         # create dict of guild configs
-        for gkey in re.compile(r',').split(config['warcraft']['guilds'].strip()):
-            guildkey = gkey.strip()
-            # copy the config to our guild
-            self._guilds[guildkey] = config[guildkey]
-            # add runfile path to the config
-            self._guilds[guildkey]['runfile'] = "{}/{}".format(self._run_dir, guildkey)
+        self._guilds = read_guilds(config)
 
 def parse_args():
     """ Parse arguments when we are invoked as a program.
@@ -193,6 +300,7 @@ def parse_args():
     """
     parser = argparse.ArgumentParser(description="Retrieve Guild News from Blizzard API.")
     parser.add_argument('--config','-c', help='the config file', default='./discord_simc.conf')
+    parser.add_argument('--service','-s', action='store_true', help='keep running and poll the guilds continuously')
     return vars(parser.parse_args())
 
 if __name__ == '__main__':
@@ -201,5 +309,11 @@ if __name__ == '__main__':
     args = parse_args()
     config_file = args['config']
     guild_news = GuildNews(config_file)
-    guild_news.run()
+    if args['service']:
+        try:
+            asyncio.get_event_loop().run_until_complete(guild_news.serve())
+        except KeyboardInterrupt:
+            log.info('interrupted')
+    else:
+        guild_news.run()
 
@@ -9,11 +9,12 @@
     and returning the response similarly.
 """
 
-import os,logging,shlex,tempfile,re,argparse,json
+import os,logging,shlex,tempfile,re,argparse,json,asyncio,time,threading
 import discord
-import overlordauth
-from urllib.request import Request,urlopen
+import blizzhttp
 import configparser
+from mountstore import MountStore
+from guild import read_guilds,roster_url
 from datetime import datetime,timedelta
 
 
@@ -21,16 +22,46 @@ class Mounts(object):
     """ Python program to retrieve a characters mounts information from blizzard.
     """
 
+    CACHE_SECONDS = 120
+
+    NEW_DAYS = 7
+
+    # members shown on a guild leaderboard and the lowest level looked up
+    LEADERBOARD_SIZE = 25
+    MIN_LEVEL = 10
+
+    CATALOG_URL = 'https://us.api.blizzard.com/data/wow/mount/index?locale=en_US'
+
     def __init__(self):
+        self._stale_seconds = 600
+        self._catalog_seconds = 86400
+        self._guild_requests = 10
+        self._guilds = {}
         if os.path.isfile('discord_simc.conf'):
             self.parse_config('discord_simc.conf')
         else:
-            self._output_path = "./cache"
             self._default_realm = "khazgoroth"
 
-        #self._auth = overlordauth.OverlordAuthFile('discord_simc.conf')
-        self._auth = overlordauth.OverlordAuthDb('discord_simc.conf')
-            
+        self._refreshing = {}
+        self._catalog = {}
+        self._catalog_ids = frozenset()
+        self._catalog_refreshed = 0
+
+        # created on first use, the bot only parses commands and builds embeds
+        self._http = None
+        self._store = None
+        self._lock = threading.Lock()
+
+    def http(self):
+        if self._http == None:
+            self._http = blizzhttp.client('discord_simc.conf')
+        return self._http
+
+    def store(self):
+        with self._lock:
+            if self._store == None:
+                self._store = MountStore('discord_simc.conf')
+        return self._store
 
     def check_realm(self,r):
         transtable = str.maketrans("","","'")
@@ -49,24 +80,10 @@ class Mounts(object):
         params = {}
         try:
             params = self.parse_args(character, **kwargs)
-            params["colour"] = 0x119911
-            params["output_realm"] = None
-            params["thumbnail"] = None
-
-            toon = self.get_data( params["realm"], params["character"], params["filename"])
-            mounts = toon["mounts"]
-            #params["lastModified"] = toon["lastModified"]
-            params["output_name"] = toon["name"]
-            params["collected"] = len(toon["mounts"])
-            params["uncollected"] = 999
-            params["output_realm"] = toon["realm"]
-            params["thumbnail"] = '' # toon["thumbnail"]
-            toon["faction"]=0
-            if toon["faction"]==0:
-                params["colour"] = 0x1111FF
-            else:
-                params["colour"] = 0xFF1111
-            logging.debug(str(params))
+            toon = self.get_data( params["realm"], params["character"])
+            self.update_params(params, toon, self.catalog())
+            if "new" in params.keys():
+                self.update_new(params)
 
             if "output" in kwargs.keys() and kwargs["output"]==1:
                 print(str(params))
@@ -78,15 +95,149 @@ class Mounts(object):
 
         return params
 
+    async def run_async(self, character, **kwargs):
+        """ The same as run but the lookup is a coroutine using the shared connection pool.
+        """
+        logging.info('Run called with character name {}'.format(character))
+        params = {}
+        try:
+            params = self.parse_args(character, **kwargs)
+            toon = await self.get_data_async( params["realm"], params["character"])
+            catalog = await asyncio.get_event_loop().run_in_executor(None, self.catalog)
+            self.update_params(params, toon, catalog)
+            if "new" in params.keys():
+                await asyncio.get_event_loop().run_in_executor(None, self.update_new, params)
+
+        except Exception as e:
+            logging.error('Exception calling mounts')
+            logging.error(str(e))
+            raise
+
+        return params
+
+    async def run_guild_async(self, guildkey):
+        """ Builds a leaderboard of the mount collections of every member of a configured
+            guild. Members are looked up concurrently with at most guild_requests requests
+            to blizzard at a time, including background refreshes of stale collections,
+            and collections already in the store are reused.
+
+        :param str guildkey: the config section of the guild
+        """
+        logging.info('Run called with guild key {}'.format(guildkey))
+        params = {}
+        try:
+            guild = self._guilds[guildkey]
+            roster = await self.get_roster_async(guild['realm'], guild['name'])
+            members = [ m["character"] for m in roster["members"] if m["character"].get("level", 0) >= self.MIN_LEVEL ]
+            semaphore = asyncio.Semaphore(self._guild_requests)
+
+            async def collected(member):
+                try:
+                    toon = await self.get_data_async(member["realm"]["slug"], member["name"].lower(), semaphore)
+                    return member["name"], len(toon["mounts"])
+                except Exception as e:
+                    logging.warning('No mounts for {}: {}'.format(member["name"], str(e)))
+                    return None
+
+            results = await asyncio.gather(*[ collected(m) for m in members ])
+            ranked = sorted( (r for r in results if r != None), key=lambda x : x[1], reverse=True)
+
+            params["guild"] = guildkey
+            params["output_name"] = guild['name']
+            params["output_realm"] = guild['realm']
+            params["members"] = len(ranked)
+            params["leaderboard"] = [ list(r) for r in ranked[ : self.LEADERBOARD_SIZE ] ]
+            catalog = await asyncio.get_event_loop().run_in_executor(None, self.catalog)
+            params["total"] = len(catalog)
+            logging.debug(str(params))
+
+        except Exception as e:
+            logging.error('Exception calling mounts')
+            logging.error(str(e))
+            raise
+
+        return params
+
+    async def get_roster_async(self, realm, name):
+        url = roster_url(realm, name)
+        logging.info(url)
+        status, headers, text = await self.http().get_async(url, namespace='profile-us')
+        return json.loads(text)
+
+    def update_params(self, params, toon, catalog):
+        params["colour"] = 0x119911
+        params["output_realm"] = None
+        params["thumbnail"] = None
+
+        collected = frozenset(toon["mounts"])
+        #params["lastModified"] = toon["lastModified"]
+        params["output_name"] = toon["name"]
+        params["collected"] = len(collected)
+        params["uncollected"] = None
+        if len(catalog) > 0:
+            params["uncollected"] = len(catalog - collected)
+        params["output_realm"] = toon["realm"]
+        params["thumbnail"] = '' # toon["thumbnail"]
+        toon["faction"]=0
+        if toon["faction"]==0:
+            params["colour"] = 0x1111FF
+        else:
+            params["colour"] = 0xFF1111
+        logging.debug(str(params))
+
+    def catalog(self):
+        """ Returns the ids of every mount in the game. The catalog is kept in memory and
+            in the store, and refreshed from the blizzard mount index once it is older
+            than catalog_seconds. A stale catalog is used if blizzard cannot be reached.
+        """
+        if self._catalog_refreshed + self._catalog_seconds > time.time():
+            return self._catalog_ids
+
+        refreshed, mounts = self.store().get_catalog()
+        if refreshed + self._catalog_seconds <= time.time():
+            try:
+                logging.info(self.CATALOG_URL)
+                index = self.http().get(self.CATALOG_URL, namespace='static-us').json()
+                mounts = { m["id"] : m["name"] for m in index["mounts"] }
+                self.store().put_catalog(mounts)
+                refreshed = time.time()
+            except Exception as e:
+                logging.error('Exception refreshing the mount catalog')
+                logging.error(str(e))
+                if len(mounts) == 0:
+                    return self._catalog_ids
+
+        self._catalog = mounts
+        self._catalog_ids = frozenset(mounts.keys())
+        self._catalog_refreshed = refreshed
+        return self._catalog_ids
+
+    def update_new(self, params):
+        """ Adds the names of the mounts that are new since the character was seen
+            before, in the changes recorded over the last NEW_DAYS days. A change is
+            stamped when the bot first sees it, not when the mount was collected.
+        """
+        new = set()
+        since = time.time() - self.NEW_DAYS*86400
+        for recorded, added, removed in self.store().get_deltas(params["realm"], params["character"], since):
+            new.update(added)
+            new.difference_update(removed)
+        params["new_mounts"] = sorted( self._catalog.get(i, str(i)) for i in new )
+
     def create_payload_from_msg(self, msg):
         """
             Strips the command from the start and turns the input into a dictionary
         """
         raw_data=msg[ len(self.cmd())+1 : ]
         words=raw_data.split()
+        if len(words) == 2 and words[0].lower() == "guild" and words[1] in self._guilds.keys():
+            return { "guild" : words[1] }
         result = {
             "character" : words[0]
         }
+        if len(words) > 1 and words[-1].lower() == "new":
+            result["new"] = 1
+            words.pop()
         if len(words) == 1:
             result["realm"] = "khazgoroth"
             logging.info('using default realm {}'.format(result["realm"]))
@@ -95,44 +246,94 @@ class Mounts(object):
         logging.info('using realm {}'.format(result["realm"]))
         return result
 
-    def get_data(self, realm, character, filename):
-        # look for existing file
-        toon = None
-        if os.path.isfile(filename):
-            nextcheck = datetime.fromtimestamp(os.path.getmtime(filename)) + timedelta(minutes=2)
-            logging.debug('file nextcheck {}'.format(str(nextcheck)))
-            if datetime.now() < nextcheck:  # use cached version
-                try:
-                    f = open(filename,"rt")
-                    toon = json.load(f)
-                    lastModified = datetime.fromtimestamp( toon["lastModified"] / 1000 )
-                    logging.debug('json last modified {}'.format(str(lastModified)))
-                except Exception as e:
-                    logging.error('Exception calling mounts')
-                    logging.error(str(e))
-                    raise
-                finally:
-                    f.close()
-
-        if toon == None:
-            # retrieve from blizz
-            logging.debug('retrieving from blizzard')
-            self._auth.load_token()
-            url='https://us.api.blizzard.com/profile/wow/character/{}/{}/collections/mounts?locale=en_US'.format(realm, character)
-            logging.info(url)
-            req = Request(url)
-            req.add_header('Authorization', "Bearer {}".format(self._auth.get_token()['access_token']))
-            req.add_header('Battlenet-Namespace', 'profile-us')
-            f=urlopen(req)
-            toonjson=f.read().decode('utf-8')
-            f.close()
-            f = open(filename,"wt")
-            f.write(toonjson)
-            f.close()
-            toon = json.loads(toonjson)
-            toon["realm"]=realm
-            toon["name"]=character
-        return toon 
+    def get_data(self, realm, character):
+        """ Returns the collection, cached for 2 minutes and then revalidated with blizzard.
+        """
+        entry = self.store().get(realm, character)
+        if self.is_fresh(entry):
+            return self.to_toon(entry["mount_ids"], realm, character)
+
+        url = self.mounts_url(realm, character)
+        logging.info(url)
+        status, headers, text = self.http().get_conditional(url, self.validators(entry), namespace='profile-us')
+        return self.update_store(entry, headers, text, realm, character)
+
+    async def get_data_async(self, realm, character, semaphore=None):
+        """ Coroutine version of get_data which serves stale while revalidating. A cached
+            collection up to stale_seconds old is returned immediately while a refresh
+            runs in the background, only one refresh runs at a time for each character.
+            While blizzard is unavailable any cached collection is returned.
+
+        :param semaphore: bounds the blizzard requests of the refresh, background or not
+        """
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(None, self.store().get, realm, character)
+        if self.is_fresh(entry):
+            return self.to_toon(entry["mount_ids"], realm, character)
+
+        key = (realm, character)
+        if key not in self._refreshing.keys():
+            task = asyncio.ensure_future(self.refresh_async(entry, realm, character, semaphore))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda t : self.refreshed(key, t))
+
+        if self.is_stale(entry) or (entry != None and not self.http().available()):
+            logging.info('serving stale collection for {}-{}'.format(character, realm))
+            return self.to_toon(entry["mount_ids"], realm, character)
+        return await asyncio.shield(self._refreshing[key])
+
+    async def refresh_async(self, entry, realm, character, semaphore=None):
+        loop = asyncio.get_event_loop()
+        url = self.mounts_url(realm, character)
+        logging.info(url)
+        if semaphore == None:
+            status, headers, text = await self.http().get_conditional_async(url, self.validators(entry), namespace='profile-us')
+        else:
+            async with semaphore:
+                status, headers, text = await self.http().get_conditional_async(url, self.validators(entry), namespace='profile-us')
+        return await loop.run_in_executor(None, self.update_store, entry, headers, text, realm, character)
+
+    def refreshed(self, key, task):
+        self._refreshing.pop(key, None)
+        if not task.cancelled() and task.exception() != None:
+            logging.warning('refresh of {}-{} failed: {}'.format(key[1], key[0], str(task.exception())))
+
+    def is_fresh(self, entry):
+        return entry != None and entry["fetched"] + self.CACHE_SECONDS > time.time()
+
+    def is_stale(self, entry):
+        return entry != None and entry["fetched"] + self._stale_seconds > time.time()
+
+    def validators(self, entry):
+        if entry == None:
+            return None
+        return entry["validators"]
+
+    def update_store(self, entry, headers, text, realm, character):
+        """ Stores the response, a body of None means blizzard reported the collection unchanged.
+        """
+        if text == None:
+            self.store().touch(realm, character)
+            return self.to_toon(entry["mount_ids"], realm, character)
+        ids = self.parse_data(text)
+        self.store().put(realm, character, ids, headers)
+        return self.to_toon(ids, realm, character)
+
+    def mounts_url(self, realm, character):
+        return 'https://us.api.blizzard.com/profile/wow/character/{}/{}/collections/mounts?locale=en_US'.format(realm, character)
+
+    def parse_data(self, toonjson):
+        """ Returns the mount ids from the collection json.
+        """
+        toon = json.loads(toonjson)
+        return [ m["mount"]["id"] for m in toon.get("mounts", []) ]
+
+    def to_toon(self, ids, realm, character):
+        return {
+            "mounts" : ids,
+            "realm" : realm,
+            "name" : character,
+        }
 
     def parse_args(self, character, **kwargs):
         """ Creates a dictionary from the arguments that were passed
@@ -146,7 +347,8 @@ class Mounts(object):
             params["realm"] = kwargs["realm"]
         else:
             params["realm"] = self._default_realm
-        params["filename"] = "./{}/{}_{}_mounts.json".format(self._output_path, params["realm"], character)
+        if "new" in kwargs.keys() and kwargs["new"] != None:
+            params["new"] = kwargs["new"]
         logging.debug(str(params))
         return params
 
@@ -158,19 +360,49 @@ class Mounts(object):
         config = configparser.ConfigParser()
         config.read(file)
         self._default_realm = config['warcraft']['default_realm']
-        self._output_path = config['mounts']['cache']
+        self._stale_seconds = config['mounts'].getint('stale_seconds', self._stale_seconds)
+        self._catalog_seconds = config['mounts'].getint('catalog_seconds', self._catalog_seconds)
+        self._guild_requests = config['mounts'].getint('guild_requests', self._guild_requests)
+        if config.has_option('warcraft', 'guilds'):
+            self._guilds = read_guilds(config)
 
     def generate_embed(self,result):
+        if "leaderboard" in result.keys():
+            return self.generate_guild_embed(result)
         embed = discord.Embed(
             url='https://worldofwarcraft.com/en-us/character/{}/{}/collections/mounts'.format(
                 result["realm"],
                 result["character"]),
             title="Mount collection",
-            description='Progress: {}/{}'.format(result["collected"],result["collected"]+result["uncollected"]),
+            description=self.progress(result),
         )
         embed.set_thumbnail(url='http://wow.zamimg.com/images/wow/icons/large/ability_mount_spectraltiger.jpg')
+        if "new_mounts" in result.keys():
+            new = '\n'.join(result["new_mounts"])
+            if len(new) == 0:
+                new = 'None'
+            elif len(new) > 1024:
+                new = new[ : new.rindex('\n', 0, 1020) ] + '\n...'
+            embed.add_field(name='New since last seen, last {} days'.format(self.NEW_DAYS), value=new, inline=False)
         return embed
 
+    def generate_guild_embed(self, result):
+        lines = [ '{}. **{}** {}'.format(i+1, name, count) for i, (name, count) in enumerate(result["leaderboard"]) ]
+        description = '\n'.join(lines)
+        if result["total"] > 0:
+            description += '\n\n{} mounts in the game'.format(result["total"])
+        embed = discord.Embed(
+            title="Mount leaderboard ({} members)".format(result["members"]),
+            description=description,
+        )
+        embed.set_thumbnail(url='http://wow.zamimg.com/images/wow/icons/large/ability_mount_spectraltiger.jpg')
+        return embed
+
+    def progress(self, result):
+        if result.get("uncollected") == None:
+            return 'Collected: {}'.format(result["collected"])
+        return 'Progress: {}/{}'.format(result["collected"],result["collected"]+result["uncollected"])
+
 def parse_args():
     """ Parse arguments when we are invoked as a program.
 
@@ -178,6 +410,7 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Retrieve World of Warcraft mount collection progress.")
     parser.add_argument('character', help='the character to lookup')
     parser.add_argument('--realm','-r', help='the warcraft realm', default='khazgoroth')
+    parser.add_argument('--new','-n', action='store_const', const=1, help='list the mounts new since the character was last seen, within the last week')
     parser.add_argument('--output','-o', action='store_const', const="1", help='whether to display the mounts text on stdout')
     return vars(parser.parse_args())
 
@@ -0,0 +1,208 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" An indexed sqlite store of mount collections, keyed on realm and character.
+"""
+
+import os,logging,time,array
+import configparser
+import sqlite3
+
+
+class MountStore(object):
+    """ Keeps each characters collection as a sorted array of mount ids rather than the
+        raw json, with the validators needed to revalidate it with blizzard. Entries
+        older than ttl are dropped and the least recently used entries are evicted
+        beyond max_entries.
+
+        Each change to a collection is recorded as the ids added and removed since the
+        character was last seen, kept for delta_days. The changes are computed against a
+        snapshot of the last collection seen, which the cache eviction does not touch, so
+        a change is stamped with the time it was first seen rather than when it happened.
+    """
+
+    def __init__(self, config_file):
+        self.logger = logging.getLogger('MountStore')
+        self._db_filename = './mounts.db'
+        self._ttl = 7*24*3600
+        self._max_entries = 5000
+        self._delta_days = 90
+        if os.path.isfile(config_file):
+            self.parse_config(config_file)
+        self.create_tables()
+
+    def connect(self):
+        conn = sqlite3.connect(self._db_filename, timeout=10)
+        conn.execute("pragma journal_mode=wal")
+        return conn
+
+    def create_tables(self):
+        conn = self.connect()
+        try:
+            conn.execute("""create table if not exists collections (
+                realm text not null,
+                character text not null,
+                fetched integer not null,
+                accessed integer not null,
+                etag text,
+                last_modified text,
+                mount_ids blob not null,
+                primary key (realm, character))""")
+            conn.execute("create index if not exists collections_accessed on collections (accessed)")
+            conn.execute("""create table if not exists deltas (
+                realm text not null,
+                character text not null,
+                recorded integer not null,
+                added blob not null,
+                removed blob not null)""")
+            conn.execute("create index if not exists deltas_character on deltas (realm, character, recorded)")
+            conn.execute("""create table if not exists snapshots (
+                realm text not null,
+                character text not null,
+                recorded integer not null,
+                mount_ids blob not null,
+                primary key (realm, character))""")
+            conn.execute("""create table if not exists catalog (
+                id integer primary key,
+                name text not null)""")
+            conn.execute("""create table if not exists catalog_state (
+                id integer primary key check (id = 0),
+                refreshed integer not null)""")
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def pack(ids):
+        return array.array('I', sorted(set(ids))).tobytes()
+
+    @staticmethod
+    def unpack(blob):
+        ids = array.array('I')
+        ids.frombytes(blob)
+        return ids
+
+    def get(self, realm, character):
+        """ Returns the entry for the character or None. The entry is a dict of the mount
+            ids, the time it was fetched and its ETag and Last-Modified validators.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("select fetched,etag,last_modified,mount_ids from collections where realm=? and character=?",
+                (realm, character))
+            row = cur.fetchone()
+            if row == None:
+                return None
+            cur.execute("update collections set accessed=? where realm=? and character=?",
+                (int(time.time()), realm, character))
+            conn.commit()
+            return {
+                "fetched" : row[0],
+                "validators" : { 'ETag' : row[1], 'Last-Modified' : row[2] },
+                "mount_ids" : self.unpack(row[3]),
+            }
+        finally:
+            conn.close()
+
+    def put(self, realm, character, ids, validators):
+        """ Stores a freshly fetched collection, records what changed since the character
+            was last seen and evicts expired and least recently used entries.
+        """
+        now = int(time.time())
+        ids = frozenset(ids)
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("begin immediate")
+            cur.execute("select mount_ids from snapshots where realm=? and character=?", (realm, character))
+            row = cur.fetchone()
+            if row != None:
+                previous = frozenset(self.unpack(row[0]))
+                if previous != ids:
+                    cur.execute("insert into deltas (realm,character,recorded,added,removed) values (?,?,?,?,?)",
+                        (realm, character, now, self.pack(ids - previous), self.pack(previous - ids)))
+            cur.execute("""insert or replace into collections
+                (realm,character,fetched,accessed,etag,last_modified,mount_ids) values (?,?,?,?,?,?,?)""",
+                (realm, character, now, now, validators.get('ETag'), validators.get('Last-Modified'), self.pack(ids)))
+            cur.execute("insert or replace into snapshots (realm,character,recorded,mount_ids) values (?,?,?,?)",
+                (realm, character, now, self.pack(ids)))
+            cur.execute("delete from collections where fetched < ?", (now - self._ttl,))
+            cur.execute("""delete from collections where rowid not in (
+                select rowid from collections order by accessed desc limit ?)""", (self._max_entries,))
+            cur.execute("delete from deltas where recorded < ?", (now - self._delta_days*86400,))
+            cur.execute("delete from snapshots where recorded < ?", (now - self._delta_days*86400,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_deltas(self, realm, character, since):
+        """ Returns the (recorded, added ids, removed ids) changes to the collection since
+            the time given, oldest first.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""select recorded,added,removed from deltas
+                where realm=? and character=? and recorded >= ? order by recorded""", (realm, character, since))
+            return [ (row[0], self.unpack(row[1]), self.unpack(row[2])) for row in cur.fetchall() ]
+        finally:
+            conn.close()
+
+    def touch(self, realm, character):
+        """ Marks the collection as fetched now, after blizzard reported it unchanged.
+        """
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            conn.execute("update collections set fetched=?, accessed=? where realm=? and character=?",
+                (now, now, realm, character))
+            conn.execute("update snapshots set recorded=? where realm=? and character=?",
+                (now, realm, character))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_catalog(self):
+        """ Returns the time the mount catalog was refreshed, 0 if never, and a dict of
+            mount id to name.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("select refreshed from catalog_state where id=0")
+            row = cur.fetchone()
+            if row == None:
+                return 0, {}
+            cur.execute("select id,name from catalog")
+            return row[0], dict(cur.fetchall())
+        finally:
+            conn.close()
+
+    def put_catalog(self, mounts):
+        """ Replaces the mount catalog with the dict of mount id to name.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("delete from catalog")
+            conn.executemany("insert into catalog (id,name) values (?,?)", mounts.items())
+            conn.execute("insert or replace into catalog_state (id,refreshed) values (0,?)", (int(time.time()),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def parse_config(self, file):
+        """ Read the local configuration from the file specified.
+
+        """
+        self.logger.debug("parsing config file: {}".format(file))
+        config = configparser.ConfigParser()
+        config.read(file)
+        if config.has_section('mounts'):
+            self._db_filename = config['mounts'].get('cache_db',
+                os.path.join(config['mounts'].get('cache', '.'), 'mounts.db'))
+            self._ttl = config['mounts'].getint('cache_ttl', self._ttl)
+            self._max_entries = config['mounts'].getint('cache_max_entries', self._max_entries)
+            self._delta_days = config['mounts'].getint('delta_days', self._delta_days)
@@ -0,0 +1,88 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" An index of the guild news items already announced, so each is announced exactly once.
+"""
+
+import os,logging,time
+import configparser
+import sqlite3
+
+
+class NewsStore(object):
+    """ Keeps every announced news item keyed on guild, type, character, achievement and
+        timestamp in sqlite. Items are only remembered for retention_days, news older
+        than that is never announced, nor is news from before a guild was first polled.
+    """
+
+    def __init__(self, config_file):
+        self.logger = logging.getLogger('NewsStore')
+        self._db_filename = './guild_news.db'
+        self._retention_days = 30
+        if os.path.isfile(config_file):
+            self.parse_config(config_file)
+        self.create_tables()
+
+    def connect(self):
+        conn = sqlite3.connect(self._db_filename, timeout=10)
+        conn.execute("pragma journal_mode=wal")
+        return conn
+
+    def create_tables(self):
+        conn = self.connect()
+        try:
+            conn.execute("""create table if not exists guilds (
+                guild text primary key,
+                first_polled integer not null)""")
+            conn.execute("""create table if not exists seen (
+                guild text not null,
+                type text not null,
+                character text not null,
+                achievement integer not null,
+                timestamp integer not null,
+                primary key (guild, type, character, achievement, timestamp))""")
+            conn.execute("create index if not exists seen_timestamp on seen (timestamp)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def select_new(self, guild, items):
+        """ Returns the news items not seen before for the guild and records them, in one
+            transaction. Blizzard timestamps are in milliseconds.
+        """
+        now = int(time.time())*1000
+        oldest = now - self._retention_days*86400*1000
+        new = []
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("begin immediate")
+            cur.execute("insert or ignore into guilds (guild,first_polled) values (?,?)", (guild, now))
+            cur.execute("select first_polled from guilds where guild=?", (guild,))
+            oldest = max(oldest, cur.fetchone()[0])
+            for item in items:
+                if item["timestamp"] <= oldest:
+                    continue
+                cur.execute("""insert or ignore into seen (guild,type,character,achievement,timestamp)
+                    values (?,?,?,?,?)""", (guild, item["type"], item.get("character", ''),
+                    item["achievement"]["id"], item["timestamp"]))
+                if cur.rowcount == 1:
+                    new.append(item)
+            cur.execute("delete from seen where timestamp < ?", (now - self._retention_days*86400*1000,))
+            conn.commit()
+        finally:
+            conn.close()
+        return new
+
+    def parse_config(self, file):
+        """ Read the local configuration from the file specified.
+
+        """
+        self.logger.debug("parsing config file: {}".format(file))
+        config = configparser.ConfigParser()
+        config.read(file)
+        if config.has_section('warcraft'):
+            self._db_filename = config['warcraft'].get('news_db', self._db_filename)
+            self._retention_days = config['warcraft'].getint('news_retention_days', self._retention_days)
@@ -7,6 +7,7 @@
 import os,logging,json,time
 import configparser
 import sqlite3
+import threading
 
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
@@ -33,14 +34,18 @@ class OverlordAuth(object):
         self.logger.debug("dummy saved")
 
     def renew_token(self):
+        token = self.fetch_token()
+        self.set_token(token)
+        self.save_token()
+        return token
+
+    def fetch_token(self):
         self.logger.debug("renewing token")
         auth = HTTPBasicAuth(self._blizzard_clientid, self._blizzard_clientsecret)
         client = BackendApplicationClient(client_id=self._blizzard_clientid)
         oauth = OAuth2Session(client=client)
         token = oauth.fetch_token(token_url='https://us.battle.net/oauth/token', auth=auth)
-        self.set_token(token)
         self.logger.debug("token renewed")
-        self.save_token()
         return token
 
 
@@ -106,51 +111,136 @@ class OverlordAuthFile(OverlordAuth):
 
 
 class OverlordAuthDb(OverlordAuth):
+    """ Keeps the token in sqlite so it is shared between processes. Within a process
+        the token is held in memory and shared by every instance using the same db, so
+        a valid token costs no sqlite access. Renewal happens inside an immediate
+        transaction which acts as a lock, the first process renews and the others
+        read its token. start_refresher renews ahead of expiry in the background.
+    """
+
+    # db filename -> token, shared by all instances in the process
+    _tokens = {}
+    _lock = threading.RLock()
+    _refreshers = {}
+
+    # the token is treated as expired this many seconds early
+    MARGIN = 30
 
     def __init__(self,config_file):
         self.logger = logging.getLogger('OverlordAuthDb')
+        self._refresh_ahead = 300
         self.parse_config(config_file)
-        self._token = None
+
+    def get_token(self):
+        return self._tokens.get(self._db_filename)
+
+    def set_token(self,token):
+        self._tokens[self._db_filename] = token
+
+    def is_valid(self, token, ahead=0):
+        return token != None and token["expires_at"] > time.time() + self.MARGIN + ahead
+
+    def connect(self):
+        conn = sqlite3.connect(self._db_filename, timeout=30, isolation_level=None)
+        conn.execute("pragma journal_mode=wal")
+        return conn
+
+    def read_token(self, conn):
+        cur = conn.cursor()
+        cur.execute("select value from settings where key='token'")
+        row = cur.fetchone()
+        if row != None:
+            return json.loads(row[0])
+        return None
 
     def load_token(self):
         token = self.get_token()
-        if os.path.isfile(self._db_filename):
-            try:
-                self.logger.debug("loading token from {}".format(self._db_filename))
-                conn = sqlite3.connect(self._db_filename)
-                cur = conn.cursor()
-                cur.execute("select value from settings where key='token'")
-                row = cur.fetchone()
-                if row != None:
-                    token = json.loads(row[0])
-                    self.set_token(token)
-                    timestamp=int(time.mktime(time.localtime())) - 30
-                    self.logger.debug("check timestamp : {}".format(str(datetime.fromtimestamp(timestamp))))
-                    self.logger.debug("expires at: {}".format(str(datetime.fromtimestamp(token["expires_at"]))))
-                    if token["expires_at"] < timestamp:
-                        token = None
-                conn.close()
+        if self.is_valid(token):
+            return token
 
-            except Exception as e:
-                self.logger.error('Exception loading ouath2 token')
-                self.logger.error(str(e))
-                raise
+        with self._lock:
+            token = self.get_token()
+            if not self.is_valid(token) and os.path.isfile(self._db_filename):
+                try:
+                    self.logger.debug("loading token from {}".format(self._db_filename))
+                    conn = self.connect()
+                    try:
+                        token = self.read_token(conn)
+                    finally:
+                        conn.close()
+                    if token != None:
+                        self.logger.debug("expires at: {}".format(str(datetime.fromtimestamp(token["expires_at"]))))
+                        self.set_token(token)
 
-        if token == None:
-            self.renew_token()
+                except Exception as e:
+                    self.logger.error('Exception loading ouath2 token')
+                    self.logger.error(str(e))
+                    raise
+
+            if not self.is_valid(token):
+                self.renew_token()
 
         return self.get_token()
 
+    def renew_token(self, ahead=0):
+        """ Renews the token unless another process already renewed it, the immediate
+            transaction holds the sqlite write lock while battle.net is called.
+        """
+        with self._lock:
+            conn = self.connect()
+            try:
+                conn.execute("begin immediate")
+                token = self.read_token(conn)
+                if self.is_valid(token, ahead):
+                    self.logger.debug("token already renewed by another process")
+                else:
+                    token = self.fetch_token()
+                    conn.execute("insert or replace into settings (key,value) values ('token',?)", (json.dumps(token),) )
+                    self.logger.debug("token saved to {}".format(self._db_filename))
+                conn.execute("commit")
+                self.set_token(token)
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("rollback")
+                raise
+            finally:
+                conn.close()
+        return token
+
     def save_token(self):
         self.logger.debug("saving token to {}".format(self._db_filename))
         value = json.dumps(self.get_token())
-        conn = sqlite3.connect(self._db_filename)
-        cur = conn.cursor()
-        cur.execute("insert or replace into settings (key,value) values ('token',?)", (value,) )
-        conn.commit()
-        conn.close()
+        conn = self.connect()
+        try:
+            conn.execute("insert or replace into settings (key,value) values ('token',?)", (value,) )
+        finally:
+            conn.close()
         self.logger.debug("token saved to {}".format(self._db_filename))
 
+    def start_refresher(self):
+        """ Starts the background thread that renews the token refresh_ahead seconds
+            before it expires, once per db in the process.
+        """
+        with self._lock:
+            if self._db_filename in self._refreshers.keys():
+                return
+            thread = threading.Thread(target=self.refresh, name='OverlordAuthDb-refresh', daemon=True)
+            self._refreshers[self._db_filename] = thread
+            thread.start()
+
+    def refresh(self):
+        while True:
+            try:
+                token = self.load_token()
+                delay = max(token["expires_at"] - self.MARGIN - self._refresh_ahead - time.time(), 60)
+                self.logger.debug("next token refresh in {:.0f}s".format(delay))
+                time.sleep(delay)
+                self.renew_token(self._refresh_ahead)
+            except Exception as e:
+                self.logger.error('Exception refreshing ouath2 token')
+                self.logger.error(str(e))
+                time.sleep(60)
+
     def parse_config(self, file):
         """ Read the local configuration from the file specified.
 
@@ -162,8 +252,8 @@ class OverlordAuthDb(OverlordAuth):
             self._blizzard_clientid = config['blizzard']['blizzard_clientid']
             self._blizzard_clientsecret = config['blizzard']['blizzard_clientsecret']
             self._db_filename = config['blizzard']['db_filename']
+            self._refresh_ahead = config['blizzard'].getint('refresh_ahead', self._refresh_ahead)
         except Exception as e:
             self.logger.error('Exception reading config from: {}'.Format(file))
             self.logger.error(str(e))
             raise
-
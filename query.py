@@ -4,15 +4,15 @@
 # Author: T'lexii (tlexii@gmail.com)
 #
 """ Retrieve and parse WoW data.
+    With --roster or --guild every character is queried concurrently in one process.
 """
 
-import os,logging,shlex,tempfile,re,argparse,json
-from urllib.request import Request,urlopen
+import os,logging,shlex,tempfile,re,argparse,json,asyncio
 import urllib.parse
 import configparser
 from datetime import datetime,timedelta
-from overlordauth import OverlordAuthDb
-#from overlordauth import OverlordAuthFile
+import blizzhttp
+from guild import read_guilds,roster_url
 
 
 class Wow(object):
@@ -21,13 +21,14 @@ class Wow(object):
     """
 
     def __init__(self):
+        self._cache_file = './query_cache.json'
+        self._guilds = {}
         if os.path.isfile('discord_simc.conf'):
             self.parse_config('discord_simc.conf')
         else:
             self._default_realm = "khazgoroth"
 
-        self._auth = OverlordAuthDb('discord_simc.conf')
-        #self._auth = OverlordAuthFile('discord_simc.conf')
+        self._http = blizzhttp.client('discord_simc.conf')
             
 
     def check_realm(self,r):
@@ -51,17 +52,7 @@ class Wow(object):
                 params["colour"] = 0xFF1111
             logging.debug(str(params))
 
-            lastlogout = self.get_lastModified(toon["lastModified"])
-
-            delta = datetime.now() - lastlogout
-            if delta.days > 0:
-                msg = "{} days ago".format(delta.days)
-            elif delta.seconds >= 7200:
-                msg = "{} hours ago".format(int(delta.seconds/3600))
-            else:
-                msg = "{} minutes ago".format(int(delta.seconds/60))
-
-            result = "{:20} {:20} {:20} {}".format(toon["name"],toon["realm"]["name"],str(lastlogout),msg)
+            lastlogout, result = self.format_row(toon)
 
         except Exception as e:
             logging.error('Exception calling query')
@@ -70,6 +61,53 @@ class Wow(object):
 
         return result
 
+    async def run_batch_async(self, members, limit=10, stream=None):
+        """ Queries every (realm, character) concurrently, at most limit at a time. Each row
+            is passed to stream as it completes. Profiles are revalidated against their
+            Last-Modified so an unchanged character costs a 304 and no parsing. A character
+            that cannot be queried is left out.
+
+        :return: the rows, most recent logout first
+        """
+        cache = self.load_cache()
+        semaphore = asyncio.Semaphore(limit)
+        rows = []
+
+        async def query(realm, character):
+            async with semaphore:
+                try:
+                    toon = await self.get_data_async(realm, character, cache)
+                    row = self.format_row(toon)
+                    rows.append(row)
+                    if stream != None:
+                        stream(row[1])
+                except Exception as e:
+                    logging.error('Exception querying {}-{}'.format(character, realm))
+                    logging.error(str(e))
+
+        await asyncio.gather(*[ query(realm, character) for realm, character in members ])
+        self.save_cache(cache)
+        return [ line for lastlogout, line in sorted(rows, key=lambda x : x[0], reverse=True) ]
+
+    def format_row(self, toon):
+        """ Returns the last logout and the line describing it.
+
+        :raises ValueError: blizzard sent no Last-Modified to take the last logout from
+        """
+        if toon["lastModified"] == None:
+            raise ValueError('no Last-Modified for {}'.format(toon["name"]))
+        lastlogout = self.get_lastModified(toon["lastModified"])
+
+        delta = datetime.now() - lastlogout
+        if delta.days > 0:
+            msg = "{} days ago".format(delta.days)
+        elif delta.seconds >= 7200:
+            msg = "{} hours ago".format(int(delta.seconds/3600))
+        else:
+            msg = "{} minutes ago".format(int(delta.seconds/60))
+
+        return lastlogout, "{:20} {:20} {:20} {}".format(toon["name"],toon["realm"]["name"],str(lastlogout),msg)
+
     def get_lastModified(self, datestr):
         # Thu, 11 Jun 2020 21:16:33 GMT
         local_date_time = datetime.strptime(datestr, '%a, %d %b %Y %H:%M:%S %Z') + timedelta(hours=10)
@@ -78,21 +116,100 @@ class Wow(object):
         
 
     def get_data(self, realm, character):
-        # retrieve from blizz
-        logging.debug('retrieving from blizzard')
-        self._auth.load_token()
-        logging.debug('access token={}'.format(self._auth.get_token()['access_token']))
+        """ Returns the cached fields of the character, revalidating them with blizzard
+            so an unchanged character costs a 304.
+        """
+        cache = self.load_cache()
+        key = '{}/{}'.format(realm, character)
+        cached = cache.get(key)
         url='https://us.api.blizzard.com/profile/wow/character/{}/{}?locale=en_US'.format(realm, urllib.parse.quote(character))
         logging.info(url)
-        req = Request(url)
-        req.add_header('Authorization', "Bearer {}".format(self._auth.get_token()['access_token']))
-        req.add_header('Battlenet-Namespace', 'profile-us')
-        f=urlopen(req)
-        toonjson=f.read().decode('utf-8')
-        f.close()
-        toon = json.loads(toonjson)
-        toon['lastModified']=str(f.info().get('Last-Modified'))
-        return toon 
+        status, headers, text = self._http.get_conditional(url, self.validators(cached), namespace='profile-us')
+        if text == None:
+            return cached
+
+        cache[key] = self.cache_entry(json.loads(text), headers)
+        self.save_cache(cache)
+        return cache[key]
+
+    async def get_data_async(self, realm, character, cache):
+        """ Coroutine version of get_data, reading and updating the cache given.
+        """
+        key = '{}/{}'.format(realm, character)
+        cached = cache.get(key)
+        url='https://us.api.blizzard.com/profile/wow/character/{}/{}?locale=en_US'.format(realm, urllib.parse.quote(character))
+        logging.info(url)
+        status, headers, text = await self._http.get_conditional_async(url, self.validators(cached),
+            namespace='profile-us', priority=blizzhttp.BACKGROUND)
+        if text == None:
+            return cached
+
+        cache[key] = self.cache_entry(json.loads(text), headers)
+        return cache[key]
+
+    def validators(self, cached):
+        """ Returns the validators to revalidate a cache entry with, or None.
+        """
+        if cached == None:
+            return None
+        return { 'ETag' : cached.get('etag'), 'Last-Modified' : cached.get('lastModified') }
+
+    def cache_entry(self, toon, headers):
+        """ Keeps just the fields shown, with the validators of the response. A missing
+            validator is kept as None so it is never sent.
+        """
+        return {
+            "name" : toon["name"],
+            "realm" : { "name" : toon["realm"]["name"] },
+            "faction" : toon["faction"],
+            "lastModified" : headers.get('Last-Modified'),
+            "etag" : headers.get('ETag'),
+        }
+
+    async def get_roster_async(self, guildkey):
+        """ Returns (realm, character) for each member of a configured guild.
+        """
+        guild = self._guilds[guildkey]
+        url = roster_url(guild['realm'], guild['name'])
+        logging.info(url)
+        status, headers, text = await self._http.get_async(url, namespace='profile-us')
+        return [ (m["character"]["realm"]["slug"], m["character"]["name"].lower()) for m in json.loads(text)["members"] ]
+
+    def read_roster(self, filename):
+        """ Returns (realm, character) for each 'character [realm]' line of the file.
+        """
+        members = []
+        f = open(filename, "rt")
+        try:
+            for line in f:
+                words = line.split()
+                if len(words) == 0 or words[0].startswith('#'):
+                    continue
+                realm = self._default_realm
+                if len(words) > 1:
+                    realm = self.check_realm(words[1])
+                members.append((realm, words[0].lower()))
+        finally:
+            f.close()
+        return members
+
+    def load_cache(self):
+        if not os.path.isfile(self._cache_file):
+            return {}
+        f = open(self._cache_file, "rt")
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+        finally:
+            f.close()
+
+    def save_cache(self, cache):
+        f = open(self._cache_file, "wt")
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
 
     def parse_args(self, character, **kwargs):
         """ Creates a dictionary from the arguments that were passed
@@ -117,15 +234,25 @@ class Wow(object):
         config = configparser.ConfigParser()
         config.read(file)
         self._default_realm = config['warcraft']['default_realm']
+        if config.has_option('warcraft', 'guilds'):
+            self._guilds = read_guilds(config)
+        if config.has_section('query'):
+            self._cache_file = config['query'].get('cache_file', self._cache_file)
 
 def parse_args():
     """ Parse arguments when we are invoked as a program.
 
     """
     parser = argparse.ArgumentParser(description="Retrieve World of Warcraft character data.")
-    parser.add_argument('character', help='the character to lookup')
+    parser.add_argument('character', nargs='?', help='the character to lookup')
     parser.add_argument('--realm','-r', help='the warcraft realm', default='khazgoroth')
-    return vars(parser.parse_args())
+    parser.add_argument('--roster', help='a file of characters to lookup, one "character [realm]" per line')
+    parser.add_argument('--guild','-g', help='lookup every member of the guild with this config key')
+    parser.add_argument('--requests', type=int, default=10, help='concurrent lookups for --roster and --guild')
+    args = vars(parser.parse_args())
+    if args['character'] == None and args['roster'] == None and args['guild'] == None:
+        parser.error('a character, --roster or --guild is required')
+    return args
 
 if __name__ == '__main__':
     LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -20s %(funcName) -25s %(lineno) -5d: %(message)s')
@@ -134,5 +261,17 @@ if __name__ == '__main__':
     character = args.pop('character')
 
     wow = Wow()
-    result = wow.run(character, **args)
-    print(result)
+    if args['roster'] != None or args['guild'] != None:
+        loop = asyncio.get_event_loop()
+        members = []
+        if args['roster'] != None:
+            members += wow.read_roster(args['roster'])
+        if args['guild'] != None:
+            members += loop.run_until_complete(wow.get_roster_async(args['guild']))
+        rows = loop.run_until_complete(wow.run_batch_async(members, args['requests'], stream=print))
+        print()
+        for row in rows:
+            print(row)
+    else:
+        result = wow.run(character, **args)
+        print(result)
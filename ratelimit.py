@@ -0,0 +1,112 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" A token bucket shared by every process calling the Blizzard API, kept in the
+    same sqlite db as the oauth token.
+"""
+
+import os,logging,time,asyncio
+import configparser
+import sqlite3
+
+# priority classes, interactive lookups may use the tokens reserved for them
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class RateLimiter(object):
+    """ Each call takes a token from the bucket, which refills at rate tokens a second
+        up to burst. Background callers leave the last reserve tokens for interactive
+        callers so guild polling never delays a !sim or !mounts lookup.
+    """
+
+    def __init__(self, config_file):
+        self.logger = logging.getLogger('RateLimiter')
+        self._db_filename = './overlord.db'
+        self._rate = 10.0
+        self._burst = 100
+        self._reserve = 20
+        if os.path.isfile(config_file):
+            self.parse_config(config_file)
+        self.create_tables()
+
+    def connect(self):
+        conn = sqlite3.connect(self._db_filename, timeout=10, isolation_level=None)
+        conn.execute("pragma journal_mode=wal")
+        return conn
+
+    def create_tables(self):
+        conn = self.connect()
+        try:
+            conn.execute("""create table if not exists rate_bucket (
+                id integer primary key check (id = 0),
+                tokens real not null,
+                updated real not null)""")
+        finally:
+            conn.close()
+
+    def take(self, priority=INTERACTIVE):
+        """ Takes a token if one is available to the priority class.
+
+        :return: 0 if a token was taken, otherwise the seconds to wait before trying again
+        """
+        needed = 1
+        if priority != INTERACTIVE:
+            needed += self._reserve
+        conn = self.connect()
+        try:
+            conn.execute("begin immediate")
+            now = time.time()
+            row = conn.execute("select tokens,updated from rate_bucket where id=0").fetchone()
+            tokens = self._burst
+            if row != None:
+                tokens = min(self._burst, row[0] + (now - row[1]) * self._rate)
+            wait = 0
+            if tokens >= needed:
+                tokens -= 1
+            else:
+                wait = (needed - tokens) / self._rate
+            conn.execute("insert or replace into rate_bucket (id,tokens,updated) values (0,?,?)", (tokens, now))
+            conn.execute("commit")
+            return wait
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("rollback")
+            raise
+        finally:
+            conn.close()
+
+    def acquire(self, priority=INTERACTIVE):
+        """ Blocks until a token is taken.
+        """
+        wait = self.take(priority)
+        while wait > 0:
+            self.logger.debug("rate limited for {:.2f}s".format(wait))
+            time.sleep(wait)
+            wait = self.take(priority)
+
+    async def acquire_async(self, priority=INTERACTIVE):
+        """ Coroutine version of acquire.
+        """
+        loop = asyncio.get_event_loop()
+        wait = await loop.run_in_executor(None, self.take, priority)
+        while wait > 0:
+            self.logger.debug("rate limited for {:.2f}s".format(wait))
+            await asyncio.sleep(wait)
+            wait = await loop.run_in_executor(None, self.take, priority)
+
+    def parse_config(self, file):
+        """ Read the local configuration from the file specified.
+
+        """
+        self.logger.debug("parsing config file: {}".format(file))
+        config = configparser.ConfigParser()
+        config.read(file)
+        if config.has_section('blizzard'):
+            self._db_filename = config['blizzard'].get('db_filename', self._db_filename)
+        if config.has_section('http'):
+            self._rate = config['http'].getfloat('rate_limit', self._rate)
+            self._burst = config['http'].getint('rate_burst', self._burst)
+            self._reserve = config['http'].getint('interactive_reserve', self._reserve)
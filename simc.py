@@ -10,12 +10,13 @@
     and returning the response similarly.
 """
 
-import os,subprocess,logging,shlex,tempfile,re,argparse,json
+import os,subprocess,logging,shlex,tempfile,re,argparse,json,hashlib,time,collections,asyncio,threading
+from concurrent.futures import ThreadPoolExecutor
 import discord
-#import urllib.request
-from urllib.request import Request,urlopen
 import configparser
-from overlordauth import OverlordAuthDb
+import blizzhttp
+from simccache import SimcCache
+from simcresult import SimcReport
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -20s %(funcName) -25s %(lineno) -5d: %(message)s')
 
@@ -32,8 +33,34 @@ class Simc(object):
             self._profile_path = "./profiles"
             self._url_prefix = "http://localhost/"
             self._default_realm = "khazgoroth"
-
-        self._auth = OverlordAuthDb('discord_simc.conf')
+            self._progress_interval = 5
+            self._prefetch_timeout = 120
+            self._lookup_ttl = 600
+            self._batch_report_ttl = 86400
+
+        # created on first use, the bot only parses commands and builds embeds
+        self._http = None
+        self._cache = None
+        self._lookup_pool = None
+        self._lock = threading.Lock()
+        self._lookups = {}
+
+    def http(self):
+        if self._http == None:
+            self._http = blizzhttp.client('discord_simc.conf')
+        return self._http
+
+    def cache(self):
+        with self._lock:
+            if self._cache == None:
+                self._cache = SimcCache('discord_simc.conf')
+        return self._cache
+
+    def lookup_pool(self):
+        with self._lock:
+            if self._lookup_pool == None:
+                self._lookup_pool = ThreadPoolExecutor(4)
+        return self._lookup_pool
 
     def check_realm(self,r):
         transtable = str.maketrans("","","'")
@@ -62,85 +89,483 @@ class Simc(object):
                 result["scaling"] = words[3]
         return result
 
-    def run(self, character, **kwargs):
+    def run(self, character, progress=None, **kwargs):
         """ Runs a simulation and then looks up additional information for the caller
 
         :param str character: name of character to sim
+        :param progress: optional callable passed a dict of phase and percent as simc runs
         """
         logging.info('Run called with character name {}'.format(character))
-        params = {}
+        result = self.run_batch([ (character, kwargs) ], progress)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run_batch(self, requests, progress=None, cpus=None):
+        """ Runs compatible requests (same movement and scaling) as a single simc invocation
+            with one actor per character and splits the results back out. Cached results
+            are returned without simulating and if the combined run fails each request
+            is simulated on its own.
+
+        :param list requests: (character, kwargs) tuples
+        :param list cpus: cores to pin simc to, simc runs a thread per core
+        :return: a result dictionary, or the exception raised, for each request in order
+        """
+        prepared = []
+        for character, kwargs in requests:
+            try:
+                prepared.append(self.prepare(character, **kwargs))
+            except Exception as e:
+                prepared.append(e)
+        results, pending = self.pending(prepared)
+
+        # the character lookups run while simc is simulating
+        for i, params in pending:
+            if params.get("toon") == None:
+                params["lookup"] = self.lookup_pool().submit(self.lookup, params)
+
+        try:
+            if len(pending) > 1:
+                self.remove_batch_reports()
+                batch = self.combine(pending, cpus)
+                try:
+                    records = self.simulate(batch, progress)
+                    for i, params, record in self.split(batch, pending, records):
+                        # an actor that fails here has been simulated, it is not run again
+                        try:
+                            if "lookup" in params.keys():
+                                params["toon"] = params.pop("lookup").result()
+                            results[i] = self.finish(params, record)
+                        except Exception as e:
+                            logging.error('Exception finishing {}'.format(params["filename"]))
+                            logging.error(str(e))
+                            results[i] = e
+                    pending = []
+                except Exception as e:
+                    logging.warning('Batch simulation failed, running individually')
+                    logging.warning(str(e))
+
+            for i, params in pending:
+                try:
+                    params["cpus"] = cpus
+                    records = self.simulate(params, progress)
+                    if "lookup" in params.keys():
+                        params["toon"] = params.pop("lookup").result()
+                    results[i] = self.finish(params, records[0])
+                except Exception as e:
+                    results[i] = e
+        finally:
+            self.discard(prepared)
+
+        return results
+
+    async def run_batch_async(self, prepared, progress=None, cpus=None, timeout=None):
+        """ The same as run_batch but for requests already passed through prepare, and
+            simc runs as an asyncio subprocess on the calling event loop. The blocking
+            lookups run on the loop's default executor.
+
+        :param list prepared: params from prepare, or the exception it raised
+        :param timeout: seconds after which a simc run is killed
+        """
+        loop = asyncio.get_event_loop()
+        results, pending = self.pending(prepared)
+
+        # the character lookups run while simc is simulating
+        for i, params in pending:
+            if params.get("toon") == None:
+                params["lookup"] = loop.run_in_executor(None, self.lookup, params)
+
+        try:
+            if len(pending) > 1:
+                await loop.run_in_executor(None, self.remove_batch_reports)
+                batch = self.combine(pending, cpus)
+                try:
+                    records = await self.simulate_async(batch, progress, timeout)
+                    for i, params, record in self.split(batch, pending, records):
+                        # an actor that fails here has been simulated, it is not run again
+                        try:
+                            if "lookup" in params.keys():
+                                params["toon"] = await params.pop("lookup")
+                            results[i] = await loop.run_in_executor(None, self.finish, params, record)
+                        except asyncio.CancelledError:
+                            raise
+                        except Exception as e:
+                            logging.error('Exception finishing {}'.format(params["filename"]))
+                            logging.error(str(e))
+                            results[i] = e
+                    pending = []
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning('Batch simulation failed, running individually')
+                    logging.warning(str(e))
+
+            for i, params in pending:
+                try:
+                    params["cpus"] = cpus
+                    records = await self.simulate_async(params, progress, timeout)
+                    if "lookup" in params.keys():
+                        params["toon"] = await params.pop("lookup")
+                    results[i] = await loop.run_in_executor(None, self.finish, params, records[0])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    results[i] = e
+        finally:
+            self.discard(prepared)
+
+        return results
+
+    def prepare(self, character, prefetch=False, **kwargs):
+        """ Parses a request and looks for a cached result. When prefetching the character
+            lookup and armory import are done now, so that simc starts from a local profile
+            and never waits on the network.
+
+        :return: the params for the request, params["cached"] holds the result on a cache hit,
+            with "stale" set when it could not be checked against the characters gear
+        :raises blizzhttp.CircuitOpenError: blizzard is unavailable and nothing is cached
+        """
+        params = self.parse_args(character, **kwargs)
+        params["echo"] = "output" in kwargs.keys() and kwargs["output"]=='1'
+        if not self.http().available():
+            # the armory import would fail, answer with the last result if there is one
+            params["fingerprint"] = None
+            params["cached"] = self.cache().get_stale(params["filename"])
+            if params["cached"] == None:
+                raise blizzhttp.CircuitOpenError('The Blizzard API is unavailable, try again later')
+            params["cached"]["stale"] = True
+            return params
+
+        params["fingerprint"] = self.fingerprint(params)
+        params["cached"] = None
+        if params["fingerprint"] != None:
+            params["cached"] = self.cache().get(params["filename"], params["fingerprint"])
+
+        if prefetch and params["cached"] == None:
+            self.prefetch(params)
+        return params
+
+    def prefetch(self, params, cpus=None):
+        """ Looks up the character and imports it from the armory into a local profile.
+
+        :param list cpus: cores to pin the armory import to
+        """
+        params["toon"] = self.lookup(params)
+        params["profile"] = self.save_profile(params, cpus)
+        params["actors"] = [ (params["realm"], params["character"], params["profile"]) ]
+        return params
+
+    def pending(self, prepared):
+        """ Splits prepared requests into the results known already and (index, params)
+            for each request still to simulate.
+        """
+        results = [ None ] * len(prepared)
+        pending = []
+        for i, params in enumerate(prepared):
+            if isinstance(params, Exception):
+                logging.error('Exception preparing simc request')
+                logging.error(str(params))
+                results[i] = params
+            elif params["cached"] != None:
+                results[i] = params["cached"]
+            else:
+                pending.append((i, params))
+        return results, pending
+
+    def combine(self, pending, cpus):
+        """ Creates the params for one simc run with an actor per pending request. The
+            actors are simulated one after another (single_actor_batch) so each result
+            is the same as a solo run, only the html report is shared.
+        """
+        names = [ params["filename"] for i,params in pending ]
+        logging.info('Batching simulation of {}'.format(str(names)))
+        batch = {
+            "movement" : pending[0][1]["movement"],
+            "scaling" : pending[0][1]["scaling"],
+            "actors" : [ params["actors"][0] for i,params in pending ],
+            "filename" : "batch_{}".format(hashlib.sha1(' '.join(names).encode('utf-8')).hexdigest()[:12]),
+            "echo" : any( params["echo"] for i,params in pending ),
+            "cpus" : cpus,
+            "single_actor_batch" : True,
+        }
+        batch["path"] = "{}/{}.html".format(self._output_path, batch["filename"])
+        batch["url"] = "{}/{}.html".format(self._url_prefix, batch["filename"])
+        return batch
+
+    def remove_batch_reports(self):
+        """ Deletes batch html reports older than batch_report_ttl seconds, cached results
+            pointing at a deleted report are no longer served.
+        """
+        expired = time.time() - self._batch_report_ttl
+        try:
+            for name in os.listdir(self._output_path):
+                path = os.path.join(self._output_path, name)
+                if name.startswith("batch_") and name.endswith(".html") and os.path.getmtime(path) < expired:
+                    logging.info('removing batch report {}'.format(path))
+                    os.unlink(path)
+        except Exception as e:
+            logging.warning('Unable to remove old batch reports')
+            logging.warning(str(e))
+
+    def split(self, batch, pending, records):
+        """ Pairs each pending request with its actor from a combined run,
+            simc reports the actors in the order they were defined.
+        """
+        if len(records) != len(pending):
+            raise ValueError('Expected {} actors, simc reported {}'.format(len(pending), len(records)))
+        for (i, params), record in zip(pending, records):
+            params["path"] = batch["path"]
+            params["url"] = batch["url"]
+            yield i, params, record
+
+    def simulate(self, params, progress=None):
+        """ Runs simc for the actors in params and returns a SimcResult for each.
+        """
         try:
-            params = self.parse_args(character, **kwargs)
             cmd= self.generate_cmd(params)
             logging.info(str(cmd))
-            
-            presult=subprocess.check_output(cmd,stderr=subprocess.STDOUT)
-            result=presult.decode('utf-8')
-            if "output" in kwargs.keys() and kwargs["output"]=='1':
-                print(result)
+            self.execute(cmd, SimcProgressParser(progress, params["echo"], self._progress_interval), params.get("cpus"))
+            return self.report(params)
 
-            params["colour"] = 0x119911
-            params["output_realm"] = None
-            params["thumbnail"] = None
+        except subprocess.CalledProcessError as e:
+            logging.error('CalledProcessError calling simc')
+            logging.error(str(e))
+            logging.error(e.output)
+            raise
 
-            self._auth.load_token()
-            url='https://us.api.blizzard.com/wow/character/{}/{}?locale=en_US'.format(params["realm"], params["character"])
-            req = Request(url)
-            req.add_header('Authorization', "Bearer {}".format(self._auth.get_token()['access_token']))
-            f=urlopen(req)
-            toonjson=f.read().decode('utf-8')
-            f.close()
-            toon = json.loads(toonjson)
+        except Exception as e:
+            logging.error('Exception calling simc')
+            logging.error(str(e))
+            raise
 
-            params["output_realm"] = toon["realm"]
-            params["thumbnail"] = toon["thumbnail"]
-            if toon["faction"]==0:
-                params["colour"] = 0x1111FF
-            else:
-                params["colour"] = 0xFF1111
+        finally:
+            self.cleanup(params)
 
-            # Player: Vengel night_elf warrior protection 110
-            match = re.search(r'^Player:\s+(\w+)\s+(\w+)\s+(\w+)\s+(\w+)\s+\d+$', result, re.I|re.M|re.U)
-            if match:
-                params["output_character"]=match.group(1).replace('_',' ').capitalize()
-                params["output_race"]=match.group(2).replace('_',' ').capitalize()
-                params["output_class"]=match.group(3).replace('_',' ').capitalize()
-                params["output_spec"]=match.group(4).replace('_',' ').capitalize()
-
-            #   DPS=6559.98 DPS-Error=5.01109/0.08% DPS-Range=983.164/14.99%
-            match = re.search(r' DPS=([\.\d]+) DPS-Error', result, re.I|re.M)
-            if match:
-                params["dps"]=match.group(1)
-            else:
-                params["dps"]=0
-
-            # Weights :  Agi=9.85(0.17)  AP=9.31(0.17)  Crit=4.83(0.16)  Haste=3.16(0.16)  Mastery=5.95(0.17)  Vers=5.05(0.16)  Wdps=9.22(0.17)  WOHdps=0.81(0.16)
-            match = re.search(r'^\s*Weights\s*:\s*(.+)?\s*$', result, re.I|re.M)
-            if match:
-                weights = match.group(1)
-                weights = re.sub(r'\([\.\d]+\)', '', weights)
-                weights = re.sub(r'\s{2,}', ' ', weights)
-                params["weights"]=weights
-            else:
-                params["weights"]=""
+    async def simulate_async(self, params, progress=None, timeout=None):
+        """ Runs simc as an asyncio subprocess for the actors in params and returns a
+            SimcResult for each. simc is killed if it exceeds the timeout or is cancelled.
+        """
+        try:
+            cmd= self.generate_cmd(params)
+            logging.info(str(cmd))
+            parser = SimcProgressParser(progress, params["echo"], self._progress_interval)
+            proc = await asyncio.create_subprocess_exec(*cmd,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            self.affinity(proc.pid, params.get("cpus"))
+            try:
+                await asyncio.wait_for(self.read_output(proc, parser), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                logging.warning('Killing simc pid {}'.format(proc.pid))
+                proc.kill()
+                await proc.wait()
+                raise
+
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output='\n'.join(parser.tail))
+            # parsing a large json2 report would stall the event loop
+            return await asyncio.get_event_loop().run_in_executor(None, self.report, params)
 
         except subprocess.CalledProcessError as e:
             logging.error('CalledProcessError calling simc')
             logging.error(str(e))
             logging.error(e.output)
             raise
-            
+
+        except asyncio.TimeoutError:
+            logging.error('Timeout calling simc')
+            raise
+
+        except asyncio.CancelledError:
+            raise
+
         except Exception as e:
             logging.error('Exception calling simc')
             logging.error(str(e))
             raise
 
         finally:
-            if "tmpfile" in params.keys() and os.path.isfile(params["tmpfile"]):
-                os.unlink( params.pop("tmpfile") )
+            self.cleanup(params)
 
+    def report(self, params):
+        """ Reads the SimcResult for each actor from the json2 report.
+        """
+        return SimcReport(params["jsonfile"]).players()
+
+    async def read_output(self, proc, parser):
+        while True:
+            chunk = await proc.stdout.read(4096)
+            parser.feed(chunk)
+            if not chunk:
+                break
+        await proc.wait()
+
+    def cleanup(self, params):
+        params.pop("cpus", None)
+        for f in ["tmpfile","jsonfile"]:
+            if f in params.keys() and os.path.isfile(params[f]):
+                os.unlink( params.pop(f) )
+
+    def discard(self, prepared):
+        """ Removes the prefetched profiles once the requests are complete.
+        """
+        for params in prepared:
+            if isinstance(params, dict) and params.get("profile") and os.path.isfile(params["profile"]):
+                os.unlink(params["profile"])
+
+    def finish(self, params, record):
+        """ Looks up the additional character information unless it was prefetched,
+            merges in the simulation result and caches it.
+        """
+        toon = params.pop("toon", None)
+        if toon == None:
+            toon = self.lookup(params)
+
+        params["colour"] = 0x119911
+        params["output_realm"] = params["realm"]
+        params["thumbnail"] = None
+        if toon != None:
+            params["output_realm"] = toon["realm"]
+            params["thumbnail"] = toon["thumbnail"]
+            if toon["faction"]==0:
+                params["colour"] = 0x1111FF
+            else:
+                params["colour"] = 0xFF1111
+
+        self.discard([ params ])
+        fingerprint = params.pop("fingerprint", None)
+        for k in ["actors","cached","echo","profile","lookup"]:
+            params.pop(k, None)
+        params.update(SimcReport.to_params(record))
+
+        if fingerprint != None:
+            self.cache().put(params["filename"], fingerprint,
+                { k:v for k,v in params.items() if k not in ["tmpfile","jsonfile"] })
         return params
 
+    def lookup(self, params):
+        """ Retrieves the characters realm, thumbnail and faction from blizzard, cached
+            per character for lookup_ttl seconds. Returns None if the lookup fails.
+        """
+        key = (params["realm"], params["character"])
+        now = time.time()
+        cached = self._lookups.get(key)
+        if cached != None and cached[0] > now:
+            logging.debug('using cached lookup for {}'.format(str(key)))
+            return cached[1]
+
+        try:
+            url='https://us.api.blizzard.com/wow/character/{}/{}?locale=en_US'.format(params["realm"], params["character"])
+            toon = self.http().get(url).json()
+
+        except Exception as e:
+            logging.error('Exception looking up {}'.format(str(key)))
+            logging.error(str(e))
+            return None
+
+        if len(self._lookups) >= 1000:
+            self._lookups = { k:v for k,v in self._lookups.items() if v[0] > now }
+        self._lookups[key] = (now + self._lookup_ttl, toon)
+        return toon
+
+    def save_profile(self, params, cpus=None):
+        """ Imports the character from the armory with a single iteration simc run and saves
+            it as a local profile, returning the path of the .simc file.
+        """
+        profile = tempfile.NamedTemporaryFile(mode='w', suffix='.simc', delete=False)
+        profile.close()
+        tmpfile = tempfile.NamedTemporaryFile(mode='w',delete=False)
+        tmpfile.write("armory=us,{},{}\n".format(params["realm"],params["character"]))
+        tmpfile.write("save={}\n".format(profile.name))
+        tmpfile.close()
+        try:
+            cmd = [ self._simc_path, tmpfile.name, "iterations=1", "threads=1" ]
+            logging.info(str(cmd))
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.affinity(proc.pid, cpus)
+            try:
+                returncode = proc.wait(timeout=self._prefetch_timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                raise
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+            return profile.name
+
+        except Exception as e:
+            logging.warning('Unable to prefetch profile for {}, simc will use the armory'.format(params["filename"]))
+            logging.warning(str(e))
+            os.unlink(profile.name)
+            return None
+
+        finally:
+            os.unlink(tmpfile.name)
+
+    def affinity(self, pid, cpus):
+        """ Pins a freshly spawned simc to cpus. This is done from the parent because a
+            preexec_fn is unsafe in the threaded daemon, simc only starts its worker
+            threads after parsing its input so they inherit the mask.
+        """
+        if cpus:
+            try:
+                os.sched_setaffinity(pid, cpus)
+            except ProcessLookupError:
+                pass
+
+    def execute(self, cmd, parser, cpus=None):
+        """ Runs simc and feeds its output to the parser as it arrives, results are read
+            from the json report so only the last lines are kept for errors.
+            When cpus is given simc is pinned to those cores.
+        """
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.affinity(proc.pid, cpus)
+        while True:
+            chunk = proc.stdout.read1(4096)
+            parser.feed(chunk)
+            if not chunk:
+                break
+
+        proc.stdout.close()
+        returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output='\n'.join(parser.tail))
+
+    def fingerprint(self, params):
+        """ Returns a cheap fingerprint of the characters gear and spec taken from the
+            profile summary, or None if it could not be retrieved and caching is skipped.
+            Blizzard update the profile on logout so any gear change alters Last-Modified.
+            The summary is revalidated with the validators of the last one fetched, a 304
+            reuses the fingerprint computed from it.
+        """
+        try:
+            url='https://us.api.blizzard.com/profile/wow/character/{}/{}?locale=en_US'.format(params["realm"], params["character"])
+            profile = self.cache().get_profile(params["realm"], params["character"])
+            validators = None
+            if profile != None:
+                validators = profile["validators"]
+            status, headers, text = self.http().get_conditional(url, validators, namespace='profile-us')
+            if text == None:
+                logging.debug('profile of {} not modified'.format(params["filename"]))
+                return profile["fingerprint"]
+
+            toon = json.loads(text)
+            lastModified = str(headers.get('Last-Modified'))
+            parts = [
+                lastModified,
+                str(toon.get("last_login_timestamp")),
+                str(toon.get("equipped_item_level")),
+                str(toon.get("active_spec",{}).get("id")),
+            ]
+            fingerprint = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+            logging.debug('fingerprint for {} is {}'.format(params["filename"], fingerprint))
+            self.cache().put_profile(params["realm"], params["character"], headers, fingerprint)
+            return fingerprint
+
+        except Exception as e:
+            logging.warning('Unable to fingerprint {}, not using cache'.format(params["filename"]))
+            logging.warning(str(e))
+            return None
+
     def parse_args(self, character, **kwargs):
         """ Creates a dictionary from the arguments that were passed
             and adds other important mappings.
@@ -174,6 +599,7 @@ class Simc(object):
 
         params["path"] = "{}/{}.html".format(self._output_path, params["filename"])
         params["url"] = "{}/{}.html".format(self._url_prefix, params["filename"])
+        params["actors"] = [ (params["realm"], character, None) ]
         logging.debug(str(params))
         return params
 
@@ -195,17 +621,33 @@ class Simc(object):
             cmd.append("{}/scaling.simc".format(self._profile_path))
         else:
             cmd.append("{}/noscaling.simc".format(self._profile_path))
+        if params.get("cpus"):
+            # overrides the threads= in basic.simc
+            cmd.append("threads={}".format(len(params["cpus"])))
+        if params.get("single_actor_batch"):
+            # no buffs or interactions between the actors of a batch
+            cmd.append("single_actor_batch=1")
         cmd.append("html={}".format(params["path"]))
+        params["jsonfile"] = "{}.json".format(params["tmpfile"])
+        cmd.append("json2={}".format(params["jsonfile"]))
         logging.debug(str(cmd))
         return cmd
         
     def create_toon_file(self,params):
-        """ Creates the input file to specify the realm and character to sim.
+        """ Creates the input file to specify the realm and character of each actor to sim,
+            using the prefetched profile where there is one.
             We want to avoid passing unchecked arguments as command parameters.
 
         """
         tmpfile = tempfile.NamedTemporaryFile(mode='w',delete=False)
-        tmpfile.write("armory=us,{},{}\n".format(params["realm"],params["character"]))
+        for realm, character, profile in params["actors"]:
+            if profile != None:
+                f = open(profile, "rt")
+                tmpfile.write(f.read())
+                tmpfile.write("\n")
+                f.close()
+            else:
+                tmpfile.write("armory=us,{},{}\n".format(realm,character))
         tmpfile.close()
         params["tmpfile"] = tmpfile.name
 
@@ -221,6 +663,10 @@ class Simc(object):
         self._profile_path = config['simc']['profile_path']
         self._url_prefix = config['simc']['url_prefix']
         self._default_realm = config['warcraft']['default_realm']
+        self._progress_interval = config['simc'].getint('progress_interval', 5)
+        self._prefetch_timeout = config['simc'].getint('prefetch_timeout', 120)
+        self._lookup_ttl = config['simc'].getint('lookup_ttl', 600)
+        self._batch_report_ttl = config['simc'].getint('batch_report_ttl', 86400)
 
     def generate_embed(self,result):
         # create the message to send to discord
@@ -236,8 +682,76 @@ class Simc(object):
             colour=result["colour"]
         )
         embed.set_thumbnail(url="https://render-us.worldofwarcraft.com/character/{}".format(result["thumbnail"]))
+        if result.get("stale"):
+            embed.set_footer(text="The Blizzard API is unavailable, this is an earlier result and may not match current gear")
         return embed
 
+class SimcProgressParser(object):
+    """ Splits simc text output into lines as it arrives and recognises the progress
+        bar lines. simc redraws its progress bar with carriage returns so both line
+        endings split. Progress is passed to the callable at most every interval
+        seconds or when the phase or actor changes.
+    """
+
+    # Generating baseline: Vengel [=========>..........] 1500/3000 00:00:02
+    PROGRESS = re.compile(r'^\s*(Generating[^:\[]*):?\s*([^\[]*?)\s*\[[=>.\s]*\]\s*(\d+)/(\d+)')
+
+    def __init__(self, progress=None, echo=False, interval=5):
+        self._progress = progress
+        self._echo = echo
+        self._interval = interval
+        self._last_phase = None
+        self._last_time = 0
+        self._buf = b''
+        self.tail = collections.deque(maxlen=50)
+
+    def feed(self, chunk):
+        """ Consumes a chunk of output, an empty chunk marks the end of output.
+        """
+        if chunk:
+            self._buf += chunk
+            lines = re.split(rb'[\r\n]', self._buf)
+            self._buf = lines.pop()
+        else:
+            lines = [ self._buf ]
+            self._buf = b''
+
+        for raw in lines:
+            line = raw.decode('utf-8', 'replace')
+            if len(line.strip()) == 0:
+                continue
+            if self._echo:
+                print(line)
+            self.tail.append(line)
+            state = self.parse_line(line)
+            if state != None and self._progress != None:
+                now = time.monotonic()
+                phase = (state["phase"], state["actor"])
+                if phase != self._last_phase or now - self._last_time >= self._interval:
+                    self._last_phase = phase
+                    self._last_time = now
+                    try:
+                        self._progress(state)
+                    except Exception as e:
+                        logging.warning('Exception reporting progress')
+                        logging.warning(str(e))
+
+    def parse_line(self, line):
+        """ Returns a dict of phase, percent and the actor being simulated for progress
+            lines, otherwise None. The actor is '' if simc did not name one.
+        """
+        match = self.PROGRESS.search(line)
+        if match:
+            done = int(match.group(3))
+            total = int(match.group(4))
+            return {
+                "phase" : match.group(1).strip(),
+                "actor" : match.group(2),
+                "percent" : int(100 * done / total) if total > 0 else 0
+            }
+        return None
+
+
 def parse_args():
     """ Parse arguments when we are invoked as a program.
 
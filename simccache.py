@@ -0,0 +1,171 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" A persistent cache of simulation results so that a repeat request for a
+    character whose gear has not changed is answered without running simc again.
+"""
+
+import os,logging,json,time
+import configparser
+import sqlite3
+
+
+class SimcCache(object):
+    """ Stores the result dictionary returned by Simc.run in sqlite.
+
+        Entries are keyed on the simulation filename (realm, character, movement
+        and scaling) which is also the name of the html report, so there is only
+        ever one valid entry per filename. The gear fingerprint is stored with the
+        entry and a lookup only hits when the fingerprint still matches.
+    """
+
+    def __init__(self, config_file):
+        self.logger = logging.getLogger('SimcCache')
+        self._db_filename = './simc_cache.db'
+        self._ttl = 3600
+        self._max_entries = 500
+        if os.path.isfile(config_file):
+            self.parse_config(config_file)
+        self.create_tables()
+
+    def connect(self):
+        return sqlite3.connect(self._db_filename, timeout=10)
+
+    def create_tables(self):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""create table if not exists simc_results (
+                filename text primary key,
+                fingerprint text not null,
+                created integer not null,
+                accessed integer not null,
+                result text not null)""")
+            cur.execute("create index if not exists simc_results_accessed on simc_results (accessed)")
+            cur.execute("""create table if not exists profiles (
+                realm text not null,
+                character text not null,
+                etag text,
+                last_modified text,
+                fingerprint text not null,
+                updated integer not null,
+                primary key (realm, character))""")
+            cur.execute("create index if not exists profiles_updated on profiles (updated)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, filename, fingerprint):
+        """ Returns the cached result for the filename or None if there is no entry,
+            it has expired, the fingerprint differs or the html report is missing.
+        """
+        now = int(time.time())
+        result = None
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("select fingerprint,created,result from simc_results where filename=?", (filename,))
+            row = cur.fetchone()
+            if row == None:
+                self.logger.debug("cache miss for {}".format(filename))
+            elif row[0] != fingerprint or row[1] < now - self._ttl:
+                self.logger.debug("cache entry stale for {}".format(filename))
+                cur.execute("delete from simc_results where filename=?", (filename,))
+                conn.commit()
+            else:
+                result = json.loads(row[2])
+                if "path" in result.keys() and not os.path.isfile(result["path"]):
+                    self.logger.debug("cached report missing for {}".format(filename))
+                    result = None
+                else:
+                    self.logger.info("cache hit for {}".format(filename))
+                    cur.execute("update simc_results set accessed=? where filename=?", (now, filename))
+                    conn.commit()
+        finally:
+            conn.close()
+        return result
+
+    def get_stale(self, filename):
+        """ Returns the last result stored for the filename whatever its fingerprint, or
+            None, for answering while the gear cannot be checked with blizzard.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("select result from simc_results where filename=?", (filename,))
+            row = cur.fetchone()
+        finally:
+            conn.close()
+        if row == None:
+            return None
+        result = json.loads(row[0])
+        if "path" in result.keys() and not os.path.isfile(result["path"]):
+            return None
+        self.logger.info("stale cache hit for {}".format(filename))
+        return result
+
+    def put(self, filename, fingerprint, result):
+        """ Stores the result and evicts expired and least recently used entries.
+        """
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("insert or replace into simc_results (filename,fingerprint,created,accessed,result) values (?,?,?,?,?)",
+                (filename, fingerprint, now, now, json.dumps(result)))
+            cur.execute("delete from simc_results where created < ?", (now - self._ttl,))
+            cur.execute("""delete from simc_results where filename not in (
+                select filename from simc_results order by accessed desc limit ?)""", (self._max_entries,))
+            conn.commit()
+            self.logger.debug("cached result for {}".format(filename))
+        finally:
+            conn.close()
+
+    def get_profile(self, realm, character):
+        """ Returns the validators of the last profile summary fetched for the character
+            and the fingerprint computed from it, or None.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("select etag,last_modified,fingerprint from profiles where realm=? and character=?",
+                (realm, character))
+            row = cur.fetchone()
+        finally:
+            conn.close()
+        if row == None:
+            return None
+        return {
+            "validators" : { 'ETag' : row[0], 'Last-Modified' : row[1] },
+            "fingerprint" : row[2],
+        }
+
+    def put_profile(self, realm, character, validators, fingerprint):
+        """ Stores the validators and fingerprint of a profile summary, keeping the
+            max_entries most recently updated characters.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""insert or replace into profiles (realm,character,etag,last_modified,fingerprint,updated)
+                values (?,?,?,?,?,?)""", (realm, character, validators.get('ETag'), validators.get('Last-Modified'),
+                fingerprint, int(time.time())))
+            cur.execute("""delete from profiles where rowid not in (
+                select rowid from profiles order by updated desc limit ?)""", (self._max_entries,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def parse_config(self, file):
+        """ Read the local configuration from the file specified.
+
+        """
+        self.logger.debug("parsing config file: {}".format(file))
+        config = configparser.ConfigParser()
+        config.read(file)
+        if config.has_section('simc'):
+            self._db_filename = config['simc'].get('cache_db', self._db_filename)
+            self._ttl = config['simc'].getint('cache_ttl', self._ttl)
+            self._max_entries = config['simc'].getint('cache_max_entries', self._max_entries)
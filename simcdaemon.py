@@ -13,9 +13,11 @@ import logging
 import asyncio
 import aioamqp
 import json
-from concurrent.futures import ProcessPoolExecutor
+import os
+import blizzhttp
 from simc import Simc
 from mounts import Mounts
+from overlordauth import OverlordAuthDb
 
 
 hostname = None
@@ -29,41 +31,114 @@ transport = None
 protocol = None
 channel = None
 queue_name = None
-executor = ProcessPoolExecutor(3)
+scheduler = None
+batcher = None
+job_timeout = None
+mounts_semaphore = None
+prefetch_semaphore = None
+prefetch_cpus = None
+prefetch_count = None
+work_queue = None
+inflight = {}
+waiters = {}
 
-def do_simc_work(body):
+def prepare_request(body):
+    """ A plain python function run in an executor as soon as a request arrives to check the cache
+    """
+    dict=json.loads(body.decode("utf-8"))
+    logging.info(str(dict))
+    character = dict.pop('character').lower()
+    return sim.prepare(character, **dict)
+
+async def simc_request(body, key, group):
+    """ Answers cached and failed requests as soon as they are prepared, only requests
+        that still need simulating wait for a batch, with their prefetch running meanwhile.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        params = await loop.run_in_executor(None, prepare_request, body)
+    except blizzhttp.CircuitOpenError as e:
+        return {"response":str(e)}
+    except Exception as e:
+        logging.error('Exception preparing simc request for {}'.format(key))
+        logging.error(str(e))
+        return {"response":"Server error - contact Vengel"}
+    if params["cached"] != None:
+        return params["cached"]
+    return await batcher.submit(asyncio.ensure_future(prefetch(params)), key, group)
+
+async def prefetch(params):
+    """ Prefetches the character data and armory profile while the request waits for its
+        batch, so simc itself never waits on the network. The armory imports are single
+        threaded and mostly wait on the network, they run on the prefetch cores kept out
+        of the scheduler's budget so they never wait for a sim.
+    """
+    loop = asyncio.get_event_loop()
+    async with prefetch_semaphore:
+        return await loop.run_in_executor(None, sim.prefetch, params, prefetch_cpus)
+
+async def do_simc_work(prepared, keys, cpus=None):
     global sim
-    """ A plain python function run in an executor which wraps the result as a future
+    """ Simulates the prepared requests as one batch with simc running as a subprocess
+        of the event loop, and returns a result for each. The actors are simulated one
+        after another, progress is published to the requesters waiting on the key of
+        the actor simc is simulating.
     """
-    logging.debug(str(body))
-    result = {}
+    results = [ {"response":"Server error - contact Vengel"} for params in prepared ]
+
+    def progress(state):
+        actor = state["actor"].lower()
+        for params, key in zip(prepared, keys):
+            if key == None or not isinstance(params, dict):
+                continue
+            # a progress line that names no actor is for every request in the run
+            if actor == '' or actor == params["character"]:
+                tagged = state.copy()
+                tagged["character"] = params["character"]
+                asyncio.ensure_future(publish_progress(key, tagged))
+
     try:
-        dict=json.loads(body.decode("utf-8"))
-        logging.info(str(dict))
-        character = dict.pop('character').lower()
-        result = sim.run(character, **dict)
-        logging.info(str(result))
+        batch = await sim.run_batch_async(prepared, progress, cpus, job_timeout)
+        for i, result in enumerate(batch):
+            if isinstance(result, blizzhttp.CircuitOpenError):
+                results[i] = {"response":str(result)}
+            elif isinstance(result, Exception):
+                logging.error('Exception calling simc for {}'.format(keys[i]))
+                logging.error(str(result))
+            else:
+                results[i] = result
+                logging.info(str(result))
+
+    except asyncio.CancelledError:
+        raise
 
     except Exception as e:
-        result["response"]="Server error - contact Vengel"
         logging.error('Exception calling simc')
         logging.error(str(e))
 
-    return result
+    return results
 
-def do_mounts_work(body):
+async def do_mounts_work(body):
     global mounts
-    """ A plain python function run in an executor which wraps the result as a future
+    """ Mounts lookups are network bound so they run as coroutines on the event loop,
+        limited separately from the simulations so they never queue behind them.
     """
     logging.debug(str(body))
     result = {}
     try:
         dict=json.loads(body.decode("utf-8"))
         logging.info(str(dict))
-        character = dict.pop('character')
-        result = mounts.run(character, **dict)
+        async with mounts_semaphore:
+            if "guild" in dict.keys():
+                result = await mounts.run_guild_async(dict["guild"])
+            else:
+                character = dict.pop('character')
+                result = await mounts.run_async(character, **dict)
         logging.info(str(result))
 
+    except blizzhttp.CircuitOpenError as e:
+        result["response"]=str(e)
+
     except Exception as e:
         result["response"]="Server error - contact Vengel"
         logging.error('Exception calling mounts')
@@ -71,21 +146,152 @@ def do_mounts_work(body):
 
     return result
 
+def parse_request(body):
+    """ Normalizes a simc request with Simc.parse_args so identical and compatible sims can be detected
+    """
+    try:
+        dict=json.loads(body.decode("utf-8"))
+        character = dict.pop('character').lower()
+        return sim.parse_args(character, **dict)
+    except Exception as e:
+        logging.error('Unable to normalize request')
+        logging.error(str(e))
+        return None
+
+class CpuScheduler(object):
+    """ Shares the machine's core budget between simc jobs. A job is given a disjoint
+        set of cores and simc runs one thread per core, so the box is never oversubscribed.
+        When idle one job gets every core, as jobs queue up each gets a narrower share.
+    """
+
+    def __init__(self, cores, max_jobs):
+        self._cores = sorted(cores)
+        self._free = list(self._cores)
+        self._max_jobs = max(1, min(max_jobs, len(self._cores)))
+        self._running = 0
+        self._waiting = 0
+        self._condition = asyncio.Condition()
+
+    def max_jobs(self):
+        return self._max_jobs
+
+    async def acquire(self):
+        """ Waits for a job slot and returns the cores for it.
+        """
+        async with self._condition:
+            self._waiting += 1
+            try:
+                while len(self._free) == 0 or self._running >= self._max_jobs:
+                    await self._condition.wait()
+                demand = min(self._max_jobs, self._running + self._waiting)
+                share = max(1, len(self._cores) // demand)
+                cpus = self._free[:share]
+                del self._free[:share]
+                self._running += 1
+                logging.info("scheduled job on cpus {} ({} running, {} waiting)".format(
+                    str(cpus), self._running, self._waiting - 1))
+                return cpus
+            finally:
+                self._waiting -= 1
+
+    async def release(self, cpus):
+        async with self._condition:
+            self._free.extend(cpus)
+            self._free.sort()
+            self._running -= 1
+            self._condition.notify_all()
+
+class SimcBatcher(object):
+    """ Collects compatible simc requests (same movement and scaling) for a short window
+        and runs them as a single simc job, resolving a future per request. Only requests
+        that still need simulating are submitted, each is prefetched while it waits for
+        the window to close.
+    """
+
+    def __init__(self, window, max_size):
+        self._window = window
+        self._max_size = max_size
+        self._pending = {}
+
+    def submit(self, prepared, key, group):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        entries = self._pending.get(group)
+        if entries == None:
+            entries = []
+            self._pending[group] = entries
+            loop.call_later(self._window, self.flush, group, entries)
+        entries.append((prepared, key, future))
+        if len(entries) >= self._max_size:
+            self.flush(group, entries)
+        return future
+
+    def flush(self, group, entries):
+        # the window timer may fire after the batch was already sent because it was full
+        if self._pending.get(group) is not entries:
+            return
+        self._pending.pop(group)
+        logging.info("submitting batch of {} simulations for {}".format(len(entries), str(group)))
+        asyncio.ensure_future(self.execute(entries))
+
+    async def execute(self, entries):
+        # wait for the prefetch stage before taking any cores
+        prepared = await asyncio.gather(
+            *[ prepared for prepared, key, future in entries ], return_exceptions=True)
+        # a batch of failed prefetches is answered without taking any cores
+        cpus = None
+        if any( isinstance(p, dict) for p in prepared ):
+            cpus = await scheduler.acquire()
+        try:
+            results = await do_simc_work(prepared,
+                [ key for prepared, key, future in entries ],
+                cpus)
+        except Exception as e:
+            logging.error('Exception running simc batch')
+            logging.error(str(e))
+            results = [ {"response":"Server error - contact Vengel"} for e in entries ]
+        finally:
+            if cpus != None:
+                await scheduler.release(cpus)
+
+        for (prepared, key, future), result in zip(entries, results):
+            if not future.done():
+                future.set_result(result)
+
 async def callback(channel, body, envelope, properties):
-    loop = asyncio.get_event_loop()
+    """ Queues each delivery for the workers, waiting while the queue is full so that
+        deliveries are never accepted faster than they are processed
+    """
+    await work_queue.put((channel, body, envelope, properties))
+
+async def worker():
+    """ Processes queued deliveries one at a time, prefetch_count workers run concurrently
+    """
+    while True:
+        channel, body, envelope, properties = await work_queue.get()
+        try:
+            await process_request(channel, body, envelope, properties)
+        except Exception as e:
+            logging.error('Exception processing request')
+            logging.error(str(e))
+            # answer the requester rather than leave them waiting, then drop the delivery
+            try:
+                await publish_response(channel, response_key(envelope), properties,
+                    {"response":"Server error - contact Vengel"})
+                await channel.basic_reject(delivery_tag=envelope.delivery_tag, requeue=False)
+            except Exception as e:
+                logging.error(str(e))
+        finally:
+            work_queue.task_done()
+
+def response_key(envelope):
+    """ The routing key to answer a delivery on
+    """
     if envelope.routing_key == simc_request_routing_key:
-        logging.info("callback invoked, running simc.py on thread_executor")
-        workerfn = do_simc_work
-        rkey = simc_response_routing_key
-    else:
-        logging.info("callback invoked, running mounts.py on thread_executor")
-        workerfn = do_mounts_work
-        rkey = mounts_response_routing_key
+        return simc_response_routing_key
+    return mounts_response_routing_key
 
-    future = asyncio.ensure_future(loop.run_in_executor(executor, workerfn, body))
-    result = await future
-    await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
-    logging.info(str(result))
+async def publish_response(channel, rkey, properties, result):
     await channel.basic_publish(
             exchange_name=exchange_name,
             routing_key=rkey,
@@ -95,7 +301,59 @@ async def callback(channel, body, envelope, properties):
                  },
             payload=json.dumps(result))
 
+async def process_request(channel, body, envelope, properties):
+    rkey = response_key(envelope)
+    if envelope.routing_key == simc_request_routing_key:
+        params = parse_request(body)
+        key = params["filename"] if params != None else None
+        future = inflight.get(key) if key != None else None
+        if future == None:
+            logging.info("callback invoked, preparing simc.py request")
+            group = (params["movement"], params["scaling"]) if params != None else None
+            future = asyncio.ensure_future(simc_request(body, key, group))
+            if key != None:
+                inflight[key] = future
+                future.add_done_callback(lambda f: inflight.pop(key, None))
+        else:
+            logging.info("callback invoked, sharing in-flight simulation of {}".format(key))
+        waiter = (properties.reply_to, properties.correlation_id)
+        waiters.setdefault(key, []).append(waiter)
+        future.add_done_callback(lambda f: remove_waiter(key, waiter))
+    else:
+        logging.info("callback invoked, running mounts.py on the event loop")
+        future = asyncio.ensure_future(do_mounts_work(body))
+
+    # every duplicate awaits the same future and replies to its own channel
+    result = await asyncio.shield(future)
+    logging.info(str(result))
+    await publish_response(channel, rkey, properties, result)
+    # only acknowledged once answered, a crash before this redelivers the request
+    await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+
+def remove_waiter(key, waiter):
+    if key in waiters.keys():
+        waiters[key].remove(waiter)
+        if len(waiters[key]) == 0:
+            waiters.pop(key)
+
+async def publish_progress(key, state):
+    """ Publishes simc progress to every requester waiting on that sim
+    """
+    logging.debug("progress {} {}".format(key, str(state)))
+    for reply_to, correlation_id in list(waiters.get(key, [])):
+        if correlation_id == None:
+            continue
+        await channel.basic_publish(
+                exchange_name=exchange_name,
+                routing_key=simc_progress_routing_key,
+                properties={
+                    'reply_to':reply_to,
+                    'correlation_id':correlation_id,
+                     },
+                payload=json.dumps(state))
+
 async def receive_request():
+    global channel
     try:
         transport, protocol = await aioamqp.connect(hostname, port)
     except aioamqp.AmqpClosedConnection:
@@ -105,8 +363,10 @@ async def receive_request():
     channel = await protocol.channel()
     await channel.exchange(exchange_name, 'topic')
 
-    result = await channel.queue(queue_name='', durable=True, auto_delete=True)
-    queue_name = result['queue']
+    # a named queue shared by every daemon, rabbitmq sends each daemon no more
+    # unacknowledged requests than it has workers for
+    await channel.basic_qos(prefetch_count=prefetch_count, prefetch_size=0, connection_global=False)
+    await channel.queue(queue_name=queue_name, durable=True, auto_delete=False)
     await channel.queue_bind(
         exchange_name=exchange_name,
         queue_name=queue_name,
@@ -119,14 +379,19 @@ async def receive_request():
         routing_key=mounts_request_routing_key
     )
 
-    logging.info("simc request consumer listening")
+    for i in range(prefetch_count):
+        asyncio.ensure_future(worker())
+
+    logging.info("simc request consumer listening with prefetch {}".format(prefetch_count))
     await channel.basic_consume(callback, queue_name=queue_name)
 
 
 def main():
     global hostname, port, exchange_name
     global sim, simc_request_routing_key, simc_response_routing_key
-    global mounts, mounts_request_routing_key, mounts_response_routing_key
+    global simc_progress_routing_key, batcher, scheduler, job_timeout, prefetch_semaphore, prefetch_cpus
+    global queue_name, prefetch_count, work_queue
+    global mounts, mounts_request_routing_key, mounts_response_routing_key, mounts_semaphore
     logging.info('attempting to start')
 
     # TODO check config valid
@@ -136,13 +401,40 @@ def main():
     port = config['rabbitmq']['port']
     exchange_name = config['simcdaemon']['exchange']
 
+    # keeps the shared blizzard token renewed ahead of expiry
+    OverlordAuthDb('discord_simc.conf').start_refresher()
+
     sim = Simc()
     simc_request_routing_key  = config['simcdaemon']['request_routing_key']
     simc_response_routing_key = config['simcdaemon']['response_routing_key']
+    simc_progress_routing_key = config['simcdaemon'].get('progress_routing_key', 'simc.progress')
+    job_timeout = config['simcdaemon'].getint('job_timeout', 1800)
+    prefetch_semaphore = asyncio.Semaphore(config['simcdaemon'].getint('prefetch_requests', 4))
+    cores = sorted(os.sched_getaffinity(0))
+    if 'cpu_cores' in config['simcdaemon']:
+        cores = [ int(c) for c in config['simcdaemon']['cpu_cores'].split(',') ]
+    # the armory imports share the first prefetch_cores, unless that leaves simc nothing
+    reserved = config['simcdaemon'].getint('prefetch_cores', 1)
+    prefetch_cpus = None
+    if reserved > 0 and len(cores) > reserved:
+        prefetch_cpus = cores[:reserved]
+        cores = cores[reserved:]
+    scheduler = CpuScheduler(cores, config['simcdaemon'].getint('max_jobs', 3))
+    batcher = SimcBatcher(
+        config['simcdaemon'].getfloat('batch_window', 2.0),
+        config['simcdaemon'].getint('batch_size', 4))
 
     mounts = Mounts()
     mounts_request_routing_key  = config['mounts']['request_routing_key']
     mounts_response_routing_key = config['mounts']['response_routing_key']
+    mounts_semaphore = asyncio.Semaphore(config['mounts'].getint('max_requests', 10))
+
+    # enough requests to fill every batch on every job slot plus the mounts lookups
+    queue_name = config['simcdaemon'].get('request_queue', 'simcdaemon.requests')
+    prefetch_count = config['simcdaemon'].getint('prefetch_count',
+        scheduler.max_jobs() * config['simcdaemon'].getint('batch_size', 4)
+        + config['mounts'].getint('max_requests', 10))
+    work_queue = asyncio.Queue(maxsize=prefetch_count)
 
     try:
         logging.debug('running daemon')
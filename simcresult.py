@@ -0,0 +1,101 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author: T'lexii (tlexii@gmail.com)
+#
+""" Parses the JSON report written by simc (json2=) into compact result records.
+"""
+
+import logging,json,collections
+
+SimcResult = collections.namedtuple('SimcResult', [
+    'name', 'race', 'class_name', 'spec', 'level', 'role',
+    'dps', 'dps_error', 'dps_min', 'dps_max',
+    'weights', 'weight_errors', 'abilities'
+])
+
+
+class SimcReport(object):
+    """ A simc JSON report, one SimcResult per simulated actor.
+    """
+
+    # the fields sent back to discord
+    PUBLISHED = ('output_character', 'output_race', 'output_class', 'output_spec', 'dps', 'weights')
+
+    CLASSES = [ 'Death Knight', 'Demon Hunter', 'Druid', 'Hunter', 'Mage', 'Monk',
+        'Paladin', 'Priest', 'Rogue', 'Shaman', 'Warlock', 'Warrior' ]
+
+    # simc reports the half width of the 95% confidence interval as DPS-Error
+    CONFIDENCE = 1.96
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger('SimcReport')
+        f = open(filename, "rt")
+        try:
+            self._report = json.load(f)
+        finally:
+            f.close()
+
+    def players(self, details=False):
+        """ Returns a SimcResult for each player in the report.
+
+        :param bool details: include per-ability damage, otherwise abilities is empty
+        """
+        return [ self.parse_player(p, details) for p in self._report["sim"]["players"] ]
+
+    def parse_player(self, player, details=False):
+        spec, class_name = self.split_specialization(player.get("specialization", ""))
+        dps = player.get("collected_data", {}).get("dps", {})
+        weights = player.get("scale_factors", {})
+        weight_errors = player.get("scale_factors_error", {})
+
+        abilities = ()
+        if details:
+            abilities = tuple(sorted(
+                ( (s["name"], s.get("portion_amount", 0)) for s in player.get("stats", []) if "name" in s ),
+                key=lambda x : x[1], reverse=True))
+
+        return SimcResult(
+            name=player.get("name", ""),
+            race=player.get("race", ""),
+            class_name=class_name,
+            spec=spec,
+            level=player.get("level", 0),
+            role=player.get("role", ""),
+            dps=dps.get("mean", 0),
+            dps_error=dps.get("mean_std_dev", 0) * self.CONFIDENCE,
+            dps_min=dps.get("min", 0),
+            dps_max=dps.get("max", 0),
+            weights=tuple( (k, v) for k,v in weights.items() if v != 0 ),
+            weight_errors=tuple(weight_errors.items()),
+            abilities=abilities)
+
+    def split_specialization(self, specialization):
+        """ simc reports e.g. 'Protection Warrior', split it into spec and class.
+        """
+        for c in self.CLASSES:
+            if specialization.endswith(c):
+                return specialization[ : -len(c) ].strip(), c
+        return specialization, ""
+
+    @classmethod
+    def to_params(cls, record, fields=PUBLISHED):
+        """ Converts a SimcResult to the result dictionary keys used by Simc.run,
+            keeping only the fields requested.
+        """
+        params = {
+            "output_character" : record.name.replace('_',' ').capitalize(),
+            "output_race" : record.race.replace('_',' ').capitalize(),
+            "output_class" : record.class_name,
+            "output_spec" : record.spec,
+            "output_level" : record.level,
+            "output_role" : record.role,
+            "dps" : "{:.2f}".format(record.dps),
+            "dps_error" : "{:.2f}".format(record.dps_error),
+            "dps_range" : "{:.0f}-{:.0f}".format(record.dps_min, record.dps_max),
+            "weights" : ' '.join( "{}={:.2f}".format(k,v) for k,v in record.weights ),
+            "abilities" : [ list(a) for a in record.abilities ],
+        }
+        if fields == None:
+            return params
+        return { k:v for k,v in params.items() if k in fields }
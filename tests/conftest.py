@@ -0,0 +1,37 @@
+import os,sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Clock(object):
+    """ A settable time.time for the stores, which all stamp rows with it.
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock(1600000000.0)
+    monkeypatch.setattr('time.time', c)
+    return c
+
+
+@pytest.fixture
+def config(tmp_path):
+    """ Writes a config file pointing every store at a db in the tmp dir.
+    """
+    def write(text):
+        path = tmp_path / 'discord_simc.conf'
+        path.write_text(text.format(tmp=tmp_path))
+        return str(path)
+    return write
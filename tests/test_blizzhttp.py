@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+from blizzhttp import CircuitBreaker,CircuitOpenError
+
+
+class Probe(object):
+    """ Fails the first failures calls, then succeeds.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise IOError('still down')
+
+
+def wait_closed(breaker):
+    for i in range(500):
+        if not breaker.is_open():
+            return True
+        threading.Event().wait(0.01)
+    return False
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(3, 60, Probe(1000))
+    breaker.record(503)
+    breaker.record(429)
+    assert not breaker.is_open()
+    breaker.check()
+    breaker.record(500)
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(2, 60, Probe(1000))
+    breaker.record(503)
+    breaker.record(200)
+    breaker.record(503)
+    assert not breaker.is_open()
+    breaker.record(404)
+    breaker.record(503)
+    assert not breaker.is_open()
+
+
+def test_probe_closes_circuit():
+    probe = Probe(2)
+    breaker = CircuitBreaker(1, 0, probe)
+    breaker.failure()
+    assert wait_closed(breaker)
+    assert probe.calls == 3
+    breaker.check()
+    # the failure count starts again once closed
+    breaker.failure()
+    assert wait_closed(breaker)
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+import blizzhttp
+from guild import GuildNews
+
+
+@pytest.fixture
+def news(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blizzhttp, 'client', lambda config_file='discord_simc.conf' : None)
+    return GuildNews(str(tmp_path / 'discord_simc.conf'))
+
+
+def item(n, type='playerAchievement'):
+    return {
+        'type' : type,
+        'character' : 'Vengel',
+        'timestamp' : 1600000000000 + n,
+        'achievement' : {
+            'id' : n,
+            'title' : 'Achievement {}'.format(n),
+            'points' : 10,
+            'description' : 'Do thing {}'.format(n),
+            'icon' : 'icon_{}'.format(n),
+        },
+    }
+
+
+def test_messages_announce_each_item(news):
+    messages = news.messages({ 'output_guild' : 'Overlords', 'news_items' : [ item(1), item(2, 'guildAchievement') ] })
+    assert len(messages) == 1
+    assert messages[0]['content'] == (
+        '**Vengel** earned achievement **Achievement 1** for 10 points\n'
+        '**Overlords** earned achievement **Achievement 2** for 10 points')
+    embed = messages[0]['embeds'][0]
+    assert embed['url'] == 'http://www.wowhead.com/achievement=1'
+    assert embed['description'] == 'Do thing 1'
+    assert embed['thumbnail']['url'] == 'http://wow.zamimg.com/images/wow/icons/large/icon_1.jpg'
+
+
+def test_messages_split_at_max_embeds(news):
+    items = [ item(n) for n in range(GuildNews.MAX_EMBEDS * 2 + 1) ]
+    messages = news.messages({ 'output_guild' : 'Overlords', 'news_items' : items })
+    assert [ len(m['embeds']) for m in messages ] == [ GuildNews.MAX_EMBEDS, GuildNews.MAX_EMBEDS, 1 ]
+    assert [ len(m['content'].split('\n')) for m in messages ] == [ GuildNews.MAX_EMBEDS, GuildNews.MAX_EMBEDS, 1 ]
+
+
+def test_messages_split_at_max_content(news, monkeypatch):
+    monkeypatch.setattr(GuildNews, 'MAX_CONTENT', 100)
+    messages = news.messages({ 'output_guild' : 'Overlords', 'news_items' : [ item(1), item(2), item(3) ] })
+    assert len(messages) == 3
+    assert all( len(m['content']) <= 100 for m in messages )
+
+
+def test_no_messages_without_news(news):
+    assert news.messages({ 'output_guild' : 'Overlords', 'news_items' : [] }) == []
+
+
+def test_rate_limit_retry_after_header(news):
+    assert news.rate_limit(429, { 'Retry-After' : '2.5' }, '') == (2.5, True)
+
+
+def test_rate_limit_retry_after_body(news):
+    assert news.rate_limit(429, {}, '{"retry_after": 0.75}') == (0.75, True)
+    assert news.rate_limit(429, {}, 'not json') == (1.0, True)
+
+
+def test_rate_limit_bucket_exhausted(news):
+    assert news.rate_limit(204, { 'X-RateLimit-Remaining' : '0', 'X-RateLimit-Reset-After' : '3' }, '') == (3.0, False)
+    assert news.rate_limit(204, { 'X-RateLimit-Remaining' : '4' }, '') == (0, False)
+
+
+def test_poll_guild_backs_off_after_errors(news, monkeypatch):
+    # the guild has no webhook so every enqueue raises a KeyError
+    news._guilds = { 'overlords' : {} }
+    polls = []
+    async def run_guild_async(guildkey):
+        polls.append(guildkey)
+        if len(polls) == 2:
+            raise IOError('connection reset')
+        return { 'output_guild' : 'Overlords', 'news_items' : [ item(len(polls)) ] }
+    sleeps = []
+    async def sleep(delay):
+        sleeps.append(delay)
+        if len(sleeps) > 4:
+            raise asyncio.CancelledError()
+    monkeypatch.setattr(news, 'run_guild_async', run_guild_async)
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(news.poll_guild('overlords'))
+    assert len(polls) == 4
+    assert sleeps[1:] == [ 120, 240, 480, 900 ]
@@ -0,0 +1,152 @@
+import asyncio,json
+
+import pytest
+
+pytest.importorskip('discord')
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+import blizzhttp
+from mounts import Mounts
+
+
+class FakeHttp(object):
+    """ Answers mount collection requests with the queued responses, in order.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.gate = None
+        self.up = True
+
+    def available(self):
+        return self.up
+
+    async def get_conditional_async(self, url, validators, **kwargs):
+        self.requests.append((url, validators))
+        if self.gate != None:
+            await self.gate.wait()
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def collection(*ids):
+    text = json.dumps({ "mounts" : [ { "mount" : { "id" : i } } for i in ids ] })
+    return 200, { 'ETag' : '"{}"'.format(len(ids)) }, text
+
+
+@pytest.fixture
+def http(monkeypatch):
+    fake = FakeHttp()
+    monkeypatch.setattr(blizzhttp, 'client', lambda config_file='discord_simc.conf' : fake)
+    return fake
+
+
+@pytest.fixture
+def mounts(tmp_path, monkeypatch, http, clock):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'discord_simc.conf').write_text("""
+[warcraft]
+default_realm = khazgoroth
+
+[mounts]
+cache_db = {}/mounts.db
+stale_seconds = 600
+""".format(tmp_path))
+    return Mounts()
+
+
+def run(coroutine):
+    async def settle():
+        result = await coroutine
+        # let background refreshes finish
+        for i in range(10):
+            await asyncio.sleep(0)
+        return result
+    return asyncio.run(settle())
+
+
+def test_miss_waits_for_blizzard(mounts, http):
+    http.responses.append(collection(6, 7))
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6, 7]
+    assert http.requests[0][1] == None
+    assert list(mounts.store().get('khazgoroth', 'vengel')["mount_ids"]) == [6, 7]
+
+
+def test_fresh_entry_served_without_a_request(mounts, http):
+    mounts.store().put('khazgoroth', 'vengel', [6], {})
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6]
+    assert http.requests == []
+
+
+def test_stale_entry_served_while_revalidating(mounts, http, clock):
+    mounts.store().put('khazgoroth', 'vengel', [6], { 'ETag' : '"a"' })
+    clock.advance(Mounts.CACHE_SECONDS + 1)
+    http.responses.append(collection(6, 7))
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6]
+    assert http.requests[0][1]["ETag"] == '"a"'
+    assert list(mounts.store().get('khazgoroth', 'vengel')["mount_ids"]) == [6, 7]
+    assert mounts._refreshing == {}
+
+
+def test_expired_entry_waits_for_revalidation(mounts, http, clock):
+    mounts.store().put('khazgoroth', 'vengel', [6], { 'ETag' : '"a"' })
+    clock.advance(601)
+    http.responses.append((304, {}, None))
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6]
+    assert mounts.store().get('khazgoroth', 'vengel')["fetched"] == int(clock.now)
+
+
+def test_one_refresh_per_character(mounts, http):
+    http.responses.append(collection(6))
+
+    async def lookups():
+        http.gate = asyncio.Event()
+        pending = asyncio.gather(
+            mounts.get_data_async('khazgoroth', 'vengel'),
+            mounts.get_data_async('khazgoroth', 'vengel'))
+        for i in range(10):
+            await asyncio.sleep(0)
+        http.gate.set()
+        return await pending
+
+    first, second = run(lookups())
+    assert list(first["mounts"]) == list(second["mounts"]) == [6]
+    assert len(http.requests) == 1
+
+
+def test_failed_background_refresh_keeps_stale_entry(mounts, http, clock):
+    mounts.store().put('khazgoroth', 'vengel', [6], {})
+    clock.advance(Mounts.CACHE_SECONDS + 1)
+    http.responses.append(IOError('blizzard is down'))
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6]
+    assert mounts._refreshing == {}
+    assert list(mounts.store().get('khazgoroth', 'vengel')["mount_ids"]) == [6]
+
+
+def test_expired_entry_served_while_blizzard_unavailable(mounts, http, clock):
+    mounts.store().put('khazgoroth', 'vengel', [6], {})
+    clock.advance(3600)
+    http.up = False
+    http.responses.append(blizzhttp.CircuitOpenError('down'))
+    toon = run(mounts.get_data_async('khazgoroth', 'vengel'))
+    assert list(toon["mounts"]) == [6]
+
+
+def test_commands_and_embeds_need_no_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    def client(config_file='discord_simc.conf'):
+        raise AssertionError('the blizzard client is not needed')
+    monkeypatch.setattr(blizzhttp, 'client', client)
+    mounts = Mounts()
+    assert mounts.create_payload_from_msg('!mounts vengel')["character"] == "vengel"
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,108 @@
+from mountstore import MountStore
+
+
+def make_store(config, ttl=3600, max_entries=10, delta_days=90):
+    return MountStore(config("""
+[mounts]
+cache_db = {{tmp}}/mounts.db
+cache_ttl = {}
+cache_max_entries = {}
+delta_days = {}
+""".format(ttl, max_entries, delta_days)))
+
+
+def test_roundtrip(config, clock):
+    store = make_store(config)
+    assert store.get('khazgoroth', 'vengel') == None
+    store.put('khazgoroth', 'vengel', [3, 1, 2, 2], { 'ETag' : '"1"' })
+    entry = store.get('khazgoroth', 'vengel')
+    assert list(entry["mount_ids"]) == [1, 2, 3]
+    assert entry["validators"] == { 'ETag' : '"1"', 'Last-Modified' : None }
+    assert entry["fetched"] == int(clock.now)
+
+
+def test_touch_marks_fetched(config, clock):
+    store = make_store(config)
+    store.put('r', 'a', [1], {})
+    clock.advance(100)
+    store.touch('r', 'a')
+    assert store.get('r', 'a')["fetched"] == int(clock.now)
+
+
+def test_expired_collections_evicted(config, clock):
+    store = make_store(config, ttl=60)
+    store.put('r', 'a', [1], {})
+    clock.advance(61)
+    store.put('r', 'b', [1], {})
+    assert store.get('r', 'a') == None
+    assert store.get('r', 'b') != None
+
+
+def test_least_recently_used_evicted(config, clock):
+    store = make_store(config, max_entries=2)
+    store.put('r', 'a', [1], {})
+    clock.advance(1)
+    store.put('r', 'b', [1], {})
+    clock.advance(1)
+    store.get('r', 'a')
+    clock.advance(1)
+    store.put('r', 'c', [1], {})
+    assert store.get('r', 'b') == None
+    assert store.get('r', 'a') != None
+
+
+def test_delta_recorded(config, clock):
+    store = make_store(config)
+    store.put('r', 'a', [1, 2], {})
+    assert store.get_deltas('r', 'a', 0) == []
+    clock.advance(10)
+    store.put('r', 'a', [1, 2], {})
+    clock.advance(10)
+    store.put('r', 'a', [2, 3], {})
+    deltas = store.get_deltas('r', 'a', 0)
+    assert [ (recorded, list(added), list(removed)) for recorded, added, removed in deltas ] == [
+        (int(clock.now), [3], [1]) ]
+    assert store.get_deltas('r', 'a', clock.now + 1) == []
+
+
+def test_old_deltas_pruned(config, clock):
+    store = make_store(config, delta_days=1)
+    store.put('r', 'a', [1], {})
+    store.put('r', 'a', [1, 2], {})
+    clock.advance(2*86400)
+    store.put('r', 'b', [1], {})
+    assert store.get_deltas('r', 'a', 0) == []
+    # the snapshot went with them, so the next fetch is a new baseline
+    store.put('r', 'a', [1, 2, 3], {})
+    assert store.get_deltas('r', 'a', 0) == []
+
+
+def test_delta_survives_eviction(config, clock):
+    store = make_store(config, ttl=60, max_entries=1)
+    store.put('r', 'a', [1], {})
+    clock.advance(1)
+    store.put('r', 'b', [1], {})
+    assert store.get('r', 'a') == None
+    clock.advance(100)
+    store.put('r', 'a', [1, 2], {})
+    assert [ list(added) for recorded, added, removed in store.get_deltas('r', 'a', 0) ] == [ [2] ]
+
+
+def test_touch_keeps_the_snapshot(config, clock):
+    store = make_store(config, delta_days=1)
+    store.put('r', 'a', [1], {})
+    clock.advance(86400 - 10)
+    store.touch('r', 'a')
+    clock.advance(20)
+    store.put('r', 'b', [1], {})
+    store.put('r', 'a', [1, 2], {})
+    assert [ list(added) for recorded, added, removed in store.get_deltas('r', 'a', 0) ] == [ [2] ]
+
+
+def test_catalog(config, clock):
+    store = make_store(config)
+    assert store.get_catalog() == (0, {})
+    store.put_catalog({ 6 : 'Brown Horse', 7 : 'Gray Wolf' })
+    assert store.get_catalog() == (int(clock.now), { 6 : 'Brown Horse', 7 : 'Gray Wolf' })
+    store.put_catalog({ 6 : 'Brown Horse' })
+    assert store.get_catalog()[1] == { 6 : 'Brown Horse' }
@@ -0,0 +1,46 @@
+from newsstore import NewsStore
+
+
+def make_store(config, retention_days=30):
+    return NewsStore(config("""
+[warcraft]
+news_db = {{tmp}}/guild_news.db
+news_retention_days = {}
+""".format(retention_days)))
+
+
+def item(character, timestamp, achievement=1):
+    return {
+        "type" : "PLAYER_ACHIEVEMENT",
+        "character" : character,
+        "achievement" : { "id" : achievement },
+        "timestamp" : timestamp,
+    }
+
+
+def test_items_announced_once(config, clock):
+    store = make_store(config)
+    store.select_new('guild', [])
+    clock.advance(10)
+    now = int(clock.now)*1000
+    items = [ item('vengel', now), item('tlexii', now) ]
+    assert store.select_new('guild', items) == items
+    assert store.select_new('guild', items) == []
+    assert store.select_new('other', items) == []
+
+
+def test_news_before_first_poll_ignored(config, clock):
+    store = make_store(config)
+    old = item('vengel', int(clock.now)*1000 - 1000)
+    assert store.select_new('guild', [ old ]) == []
+    clock.advance(10)
+    new = item('vengel', int(clock.now)*1000)
+    assert store.select_new('guild', [ old, new ]) == [ new ]
+
+
+def test_news_older_than_retention_ignored(config, clock):
+    store = make_store(config, retention_days=1)
+    store.select_new('guild', [])
+    clock.advance(3*86400)
+    old = item('vengel', int(clock.now)*1000 - 2*86400*1000)
+    assert store.select_new('guild', [ old ]) == []
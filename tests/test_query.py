@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+import blizzhttp
+from query import Wow
+
+
+@pytest.fixture
+def wow(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blizzhttp, 'client', lambda config_file='discord_simc.conf' : None)
+    return Wow()
+
+
+def test_batch_streams_rows_and_returns_them_sorted(wow, monkeypatch):
+    logouts = {
+        'vengel' : 'Thu, 11 Jun 2020 21:16:33 GMT',
+        'tlexii' : 'Fri, 12 Jun 2020 21:16:33 GMT',
+        'missing' : None,
+    }
+    async def get_data_async(realm, character, cache):
+        if character == 'broken':
+            raise IOError('connection reset')
+        return { "name" : character, "realm" : { "name" : realm }, "faction" : 0, "lastModified" : logouts[character] }
+    monkeypatch.setattr(wow, 'get_data_async', get_data_async)
+    streamed = []
+    members = [ ('khazgoroth', c) for c in [ 'vengel', 'broken', 'tlexii', 'missing' ] ]
+    rows = asyncio.run(wow.run_batch_async(members, stream=streamed.append))
+    # rows stream in the order they complete, a failed lookup is left out of both
+    assert len(streamed) == 2
+    assert 'vengel' in streamed[0] and 'tlexii' in streamed[1]
+    assert rows == [ streamed[1], streamed[0] ]
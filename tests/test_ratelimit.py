@@ -0,0 +1,59 @@
+import pytest
+
+from ratelimit import RateLimiter,INTERACTIVE,BACKGROUND
+
+
+def make_limiter(config, rate=10, burst=5, reserve=2):
+    return RateLimiter(config("""
+[blizzard]
+db_filename = {{tmp}}/overlord.db
+
+[http]
+rate_limit = {}
+rate_burst = {}
+interactive_reserve = {}
+""".format(rate, burst, reserve)))
+
+
+def test_burst_then_wait(config, clock):
+    limiter = make_limiter(config, rate=10, burst=5)
+    for i in range(5):
+        assert limiter.take() == 0
+    assert limiter.take() == pytest.approx(0.1)
+
+
+def test_refill(config, clock):
+    limiter = make_limiter(config, rate=10, burst=5)
+    for i in range(5):
+        limiter.take()
+    clock.advance(0.35)
+    for i in range(3):
+        assert limiter.take() == 0
+    assert limiter.take() > 0
+
+
+def test_refill_capped_at_burst(config, clock):
+    limiter = make_limiter(config, rate=10, burst=5)
+    limiter.take()
+    clock.advance(3600)
+    for i in range(5):
+        assert limiter.take() == 0
+    assert limiter.take() > 0
+
+
+def test_background_leaves_interactive_reserve(config, clock):
+    limiter = make_limiter(config, rate=10, burst=5, reserve=2)
+    for i in range(3):
+        assert limiter.take(BACKGROUND) == 0
+    assert limiter.take(BACKGROUND) == pytest.approx(0.1)
+    for i in range(2):
+        assert limiter.take(INTERACTIVE) == 0
+    assert limiter.take(INTERACTIVE) > 0
+
+
+def test_limiters_share_the_bucket(config, clock):
+    first = make_limiter(config, burst=2)
+    second = make_limiter(config, burst=2)
+    assert first.take() == 0
+    assert second.take() == 0
+    assert first.take() > 0
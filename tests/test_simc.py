@@ -0,0 +1,145 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip('discord')
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+import blizzhttp
+from simc import Simc,SimcProgressParser
+
+
+def test_parse_line():
+    parser = SimcProgressParser()
+    assert parser.parse_line('Generating baseline: Vengel [=========>..........] 1500/3000 00:00:02') == {
+        "phase" : "Generating baseline", "actor" : "Vengel", "percent" : 50 }
+    assert parser.parse_line('Generating Scale Factors: Tlexii [===>................] 300/1500') == {
+        "phase" : "Generating Scale Factors", "actor" : "Tlexii", "percent" : 20 }
+    assert parser.parse_line('Generating baseline: Vengel [....................] 0/0') == {
+        "phase" : "Generating baseline", "actor" : "Vengel", "percent" : 0 }
+    assert parser.parse_line('Generating baseline [====>...............] 10/50') == {
+        "phase" : "Generating baseline", "actor" : "", "percent" : 20 }
+    assert parser.parse_line('Player: Vengel night_elf warrior protection 110') == None
+
+
+def test_feed_splits_chunks_on_both_line_endings():
+    states = []
+    parser = SimcProgressParser(states.append, interval=0)
+    parser.feed(b'Generating baseline: Vengel [=>....] 10/100\rGenerating base')
+    parser.feed(b'line: Vengel [==>...] 20/100\r\nPlayer: Vengel')
+    assert [ s["percent"] for s in states ] == [ 10, 20 ]
+    assert list(parser.tail)[-1] == 'Generating baseline: Vengel [==>...] 20/100'
+    # an empty chunk marks the end of output and flushes the last partial line
+    parser.feed(b'')
+    assert list(parser.tail)[-1] == 'Player: Vengel'
+
+
+def test_feed_throttles_progress_within_a_phase():
+    states = []
+    parser = SimcProgressParser(states.append, interval=60)
+    parser.feed(b'Generating baseline: Vengel [=>....] 10/100\n')
+    parser.feed(b'Generating baseline: Vengel [==>...] 20/100\n')
+    parser.feed(b'Generating Scale Factors: Vengel [=>....] 10/100\n')
+    assert [ (s["phase"], s["percent"]) for s in states ] == [
+        ("Generating baseline", 10), ("Generating Scale Factors", 10) ]
+
+
+def test_feed_reports_each_actor():
+    states = []
+    parser = SimcProgressParser(states.append, interval=60)
+    parser.feed(b'Generating baseline: Vengel [=>....] 10/100\n')
+    parser.feed(b'Generating baseline: Vengel [=====>] 90/100\n')
+    parser.feed(b'Generating baseline: Tlexii [=>....] 10/100\n')
+    assert [ (s["actor"], s["percent"]) for s in states ] == [ ("Vengel", 10), ("Tlexii", 10) ]
+
+
+def test_feed_survives_a_failing_callback():
+    def progress(state):
+        raise RuntimeError('channel closed')
+    parser = SimcProgressParser(progress, interval=0)
+    parser.feed(b'Generating baseline: Vengel [=>....] 10/100\n')
+    assert len(parser.tail) == 1
+
+
+def test_commands_and_embeds_need_no_stores(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    def client(config_file='discord_simc.conf'):
+        raise AssertionError('the blizzard client is not needed')
+    monkeypatch.setattr(blizzhttp, 'client', client)
+    simc = Simc()
+    assert simc.create_payload_from_msg('!sim vengel khazgoroth') == { "character" : "vengel", "realm" : "khazgoroth" }
+    embed = simc.generate_embed({
+        "output_character" : "Vengel", "dps" : "1.00", "output_realm" : "Khaz'goroth",
+        "output_race" : "Night elf", "output_spec" : "Protection", "output_class" : "Warrior",
+        "weights" : "", "url" : "http://localhost/vengel.html", "colour" : 0x1111FF, "thumbnail" : "v.jpg",
+    })
+    assert embed.title == "Vengel : 1.00 dps"
+    assert list(tmp_path.iterdir()) == []
+
+
+def prepared_batch(simc):
+    prepared = []
+    for character in [ 'vengel', 'tlexii' ]:
+        params = simc.parse_args(character)
+        params.update({ "cached" : None, "echo" : False, "toon" : {},
+            "actors" : [ ("khazgoroth", character, None) ] })
+        prepared.append(params)
+    return prepared
+
+
+@pytest.fixture
+def simc(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    simc = Simc()
+    runs = []
+    def finish(params, record):
+        if record == 'tlexii':
+            raise IOError('database is locked')
+        return { "character" : params["character"], "dps" : record }
+    monkeypatch.setattr(simc, 'finish', finish)
+    simc.runs = runs
+    return simc
+
+
+def test_batch_keeps_results_when_one_actor_fails_to_finish(simc, monkeypatch):
+    def simulate(params, progress=None):
+        simc.runs.append(params["filename"])
+        return [ 'vengel', 'tlexii' ]
+    monkeypatch.setattr(simc, 'simulate', simulate)
+    prepared = prepared_batch(simc)
+    monkeypatch.setattr(simc, 'prepare', lambda character, **kwargs : prepared.pop(0))
+    results = simc.run_batch([ ('vengel', {}), ('tlexii', {}) ])
+    assert results[0] == { "character" : "vengel", "dps" : "vengel" }
+    assert isinstance(results[1], IOError)
+    assert len(simc.runs) == 1 and simc.runs[0].startswith('batch_')
+
+
+def test_async_batch_keeps_results_when_one_actor_fails_to_finish(simc, monkeypatch):
+    async def simulate_async(params, progress=None, timeout=None):
+        simc.runs.append(params["filename"])
+        return [ 'vengel', 'tlexii' ]
+    monkeypatch.setattr(simc, 'simulate_async', simulate_async)
+    results = asyncio.run(simc.run_batch_async(prepared_batch(simc)))
+    assert results[0] == { "character" : "vengel", "dps" : "vengel" }
+    assert isinstance(results[1], IOError)
+    assert len(simc.runs) == 1 and simc.runs[0].startswith('batch_')
+
+
+def test_async_report_work_runs_off_the_event_loop(simc, monkeypatch):
+    threads = {}
+    def record(name, value=None):
+        def f(*args):
+            threads[name] = threading.current_thread()
+            return value
+        return f
+    monkeypatch.setattr(simc, 'generate_cmd', lambda params : [ sys.executable, '-c', 'pass' ])
+    monkeypatch.setattr(simc, 'report', record('report', [ 'vengel', 'tlexii' ]))
+    monkeypatch.setattr(simc, 'remove_batch_reports', record('remove_batch_reports'))
+    results = asyncio.run(simc.run_batch_async(prepared_batch(simc)))
+    assert results[0] == { "character" : "vengel", "dps" : "vengel" }
+    assert set(threads.keys()) == { 'report', 'remove_batch_reports' }
+    assert threading.main_thread() not in threads.values()
@@ -0,0 +1,69 @@
+from simccache import SimcCache
+
+
+def make_cache(config, ttl=3600, max_entries=2):
+    return SimcCache(config("""
+[simc]
+cache_db = {{tmp}}/simc_cache.db
+cache_ttl = {}
+cache_max_entries = {}
+""".format(ttl, max_entries)))
+
+
+def test_hit_needs_matching_fingerprint(config, clock):
+    cache = make_cache(config)
+    cache.put('khazgoroth_vengel', 'abc', {"dps" : 1})
+    assert cache.get('khazgoroth_vengel', 'abc') == {"dps" : 1}
+    assert cache.get('khazgoroth_vengel', 'def') == None
+    # a mismatch drops the entry
+    assert cache.get('khazgoroth_vengel', 'abc') == None
+
+
+def test_entry_expires_after_ttl(config, clock):
+    cache = make_cache(config, ttl=60)
+    cache.put('khazgoroth_vengel', 'abc', {"dps" : 1})
+    clock.advance(61)
+    assert cache.get('khazgoroth_vengel', 'abc') == None
+
+
+def test_least_recently_used_evicted(config, clock):
+    cache = make_cache(config, max_entries=2)
+    cache.put('a', 'x', {"dps" : 1})
+    clock.advance(1)
+    cache.put('b', 'x', {"dps" : 2})
+    clock.advance(1)
+    assert cache.get('a', 'x') != None
+    clock.advance(1)
+    cache.put('c', 'x', {"dps" : 3})
+    assert cache.get('b', 'x') == None
+    assert cache.get('a', 'x') != None
+    assert cache.get('c', 'x') != None
+
+
+def test_stale_ignores_fingerprint(config, clock):
+    cache = make_cache(config)
+    cache.put('a', 'x', {"dps" : 1})
+    assert cache.get_stale('a') == {"dps" : 1}
+    assert cache.get_stale('b') == None
+
+
+def test_missing_report_is_a_miss(config, clock, tmp_path):
+    cache = make_cache(config)
+    cache.put('a', 'x', {"dps" : 1, "path" : str(tmp_path / 'a.html')})
+    assert cache.get('a', 'x') == None
+    assert cache.get_stale('a') == None
+
+
+
+def test_profile_validators(config, clock):
+    cache = make_cache(config, max_entries=1)
+    assert cache.get_profile('khazgoroth', 'vengel') == None
+    cache.put_profile('khazgoroth', 'vengel', { 'ETag' : '"1"', 'Last-Modified' : 'Thu' }, 'abc')
+    assert cache.get_profile('khazgoroth', 'vengel') == {
+        "validators" : { 'ETag' : '"1"', 'Last-Modified' : 'Thu' },
+        "fingerprint" : 'abc',
+    }
+    clock.advance(1)
+    cache.put_profile('khazgoroth', 'tlexii', {}, 'def')
+    assert cache.get_profile('khazgoroth', 'vengel') == None
+    assert cache.get_profile('khazgoroth', 'tlexii')["fingerprint"] == 'def'
@@ -0,0 +1,217 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aioamqp')
+pytest.importorskip('discord')
+pytest.importorskip('requests')
+pytest.importorskip('aiohttp')
+pytest.importorskip('requests_oauthlib')
+
+import blizzhttp
+import simcdaemon
+from simcdaemon import CpuScheduler,SimcBatcher
+
+
+def prepared():
+    """ A finished prefetch stage for a request that still needs simulating.
+    """
+    future = asyncio.get_event_loop().create_future()
+    future.set_result({"cached" : None})
+    return future
+
+
+def test_idle_job_gets_every_core():
+    async def run():
+        scheduler = CpuScheduler([3, 2, 1, 0], 2)
+        cpus = await scheduler.acquire()
+        assert cpus == [0, 1, 2, 3]
+        await scheduler.release(cpus)
+    asyncio.run(run())
+
+
+def test_queued_jobs_share_the_cores():
+    async def run():
+        scheduler = CpuScheduler([0, 1, 2, 3], 2)
+        first = await scheduler.acquire()
+        second = asyncio.ensure_future(scheduler.acquire())
+        third = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        await scheduler.release(first)
+        # two jobs now want the box, each gets half of it
+        assert await asyncio.wait_for(second, 1) == [0, 1]
+        assert await asyncio.wait_for(third, 1) == [2, 3]
+    asyncio.run(run())
+
+
+def test_max_jobs_limited_by_cores():
+    assert CpuScheduler([0, 1], 8).max_jobs() == 2
+    assert CpuScheduler([0, 1], 0).max_jobs() == 1
+
+
+def test_batches_grouped_by_movement_and_scaling(monkeypatch):
+    batches = []
+
+    async def do_simc_work(prepared, keys, cpus=None):
+        batches.append(sorted(keys))
+        return [ {"key" : key} for key in keys ]
+
+    async def run():
+        monkeypatch.setattr(simcdaemon, 'scheduler', CpuScheduler([0, 1], 1))
+        monkeypatch.setattr(simcdaemon, 'do_simc_work', do_simc_work)
+        batcher = SimcBatcher(0.05, 10)
+        futures = [
+            batcher.submit(prepared(), 'a', ('patchwerk', 0)),
+            batcher.submit(prepared(), 'b', ('patchwerk', 0)),
+            batcher.submit(prepared(), 'c', ('light', 0)),
+        ]
+        results = await asyncio.wait_for(asyncio.gather(*futures), 1)
+        assert [ r["key"] for r in results ] == [ 'a', 'b', 'c' ]
+
+    asyncio.run(run())
+    assert sorted(batches) == [ ['a', 'b'], ['c'] ]
+
+
+def test_full_batch_sent_before_window(monkeypatch):
+    batches = []
+
+    async def do_simc_work(prepared, keys, cpus=None):
+        batches.append(keys)
+        return [ {"key" : key} for key in keys ]
+
+    async def run():
+        monkeypatch.setattr(simcdaemon, 'scheduler', CpuScheduler([0, 1], 1))
+        monkeypatch.setattr(simcdaemon, 'do_simc_work', do_simc_work)
+        batcher = SimcBatcher(60, 2)
+        futures = [ batcher.submit(prepared(), key, None) for key in [ 'a', 'b', 'c' ] ]
+        await asyncio.wait_for(asyncio.gather(*futures[:2]), 1)
+        assert not futures[2].done()
+
+    asyncio.run(run())
+    assert batches == [ ['a', 'b'] ]
+
+
+def test_failed_batch_answers_every_request(monkeypatch):
+    async def do_simc_work(prepared, keys, cpus=None):
+        raise RuntimeError('simc crashed')
+
+    async def run():
+        monkeypatch.setattr(simcdaemon, 'scheduler', CpuScheduler([0, 1], 1))
+        monkeypatch.setattr(simcdaemon, 'do_simc_work', do_simc_work)
+        batcher = SimcBatcher(0.01, 10)
+        futures = [ batcher.submit(prepared(), key, None) for key in [ 'a', 'b' ] ]
+        return await asyncio.wait_for(asyncio.gather(*futures), 1)
+
+    results = asyncio.run(run())
+    assert [ r["response"] for r in results ] == [ "Server error - contact Vengel" ] * 2
+
+
+def test_progress_published_to_the_actors_requester(monkeypatch):
+    published = []
+
+    class Sim(object):
+        async def run_batch_async(self, prepared, progress, cpus, timeout):
+            progress({ "phase" : "Generating baseline", "actor" : "Vengel", "percent" : 50 })
+            progress({ "phase" : "Generating baseline", "actor" : "Tlexii", "percent" : 10 })
+            progress({ "phase" : "Generating baseline", "actor" : "", "percent" : 99 })
+            await asyncio.sleep(0)
+            return [ {"dps" : 1}, {"dps" : 2} ]
+
+    async def publish_progress(key, state):
+        published.append((key, state["character"], state["percent"]))
+
+    monkeypatch.setattr(simcdaemon, 'sim', Sim())
+    monkeypatch.setattr(simcdaemon, 'publish_progress', publish_progress)
+    prepared = [ {"character" : "vengel"}, {"character" : "tlexii"} ]
+    results = asyncio.run(simcdaemon.do_simc_work(prepared, [ 'k_vengel', 'k_tlexii' ]))
+    assert results == [ {"dps" : 1}, {"dps" : 2} ]
+    assert sorted(published) == [
+        ('k_tlexii', 'tlexii', 10), ('k_tlexii', 'tlexii', 99),
+        ('k_vengel', 'vengel', 50), ('k_vengel', 'vengel', 99) ]
+
+
+class PrefetchSim(object):
+    """ Answers prepare from the cache for 'cached' and records the armory imports.
+    """
+
+    def __init__(self):
+        self.imports = []
+
+    def prepare(self, character, **kwargs):
+        return { "character" : character, "cached" : {"dps" : 1} if character == 'cached' else None }
+
+    def prefetch(self, params, cpus=None):
+        self.imports.append((params["character"], cpus))
+        params["profile"] = 'profile.simc'
+        return params
+
+
+def test_prefetch_runs_imports_beside_a_busy_scheduler(monkeypatch):
+    fake = PrefetchSim()
+
+    async def run():
+        scheduler = CpuScheduler([1, 2], 1)
+        monkeypatch.setattr(simcdaemon, 'sim', fake)
+        monkeypatch.setattr(simcdaemon, 'scheduler', scheduler)
+        monkeypatch.setattr(simcdaemon, 'prefetch_semaphore', asyncio.Semaphore(1))
+        monkeypatch.setattr(simcdaemon, 'prefetch_cpus', [0])
+        busy = await scheduler.acquire()
+        params = await asyncio.wait_for(simcdaemon.prefetch({ "character" : "vengel", "cached" : None }), 1)
+        await scheduler.release(busy)
+        return params
+
+    params = asyncio.run(run())
+    assert params["profile"] == 'profile.simc'
+    assert fake.imports == [ ('vengel', [0]) ]
+
+
+def test_cache_hits_answered_without_a_batch(monkeypatch):
+    fake = PrefetchSim()
+
+    async def run():
+        semaphore = asyncio.Semaphore(1)
+        monkeypatch.setattr(simcdaemon, 'sim', fake)
+        monkeypatch.setattr(simcdaemon, 'prefetch_semaphore', semaphore)
+        monkeypatch.setattr(simcdaemon, 'batcher', SimcBatcher(60, 10))
+        async with semaphore:
+            return await asyncio.wait_for(simcdaemon.simc_request(b'{"character":"cached"}', 'k', None), 1)
+
+    assert asyncio.run(run()) == {"dps" : 1}
+    assert fake.imports == []
+
+
+def test_failed_prepare_answered_without_a_batch(monkeypatch):
+    class Sim(object):
+        def prepare(self, character, **kwargs):
+            raise blizzhttp.CircuitOpenError('The Blizzard API is unavailable, try again later')
+
+    async def run():
+        monkeypatch.setattr(simcdaemon, 'sim', Sim())
+        monkeypatch.setattr(simcdaemon, 'batcher', SimcBatcher(60, 10))
+        return await asyncio.wait_for(simcdaemon.simc_request(b'{"character":"vengel"}', 'k', None), 1)
+
+    assert asyncio.run(run()) == {"response" : 'The Blizzard API is unavailable, try again later'}
+
+
+def test_uncached_requests_batched_after_prefetch(monkeypatch):
+    fake = PrefetchSim()
+    batches = []
+
+    async def do_simc_work(prepared, keys, cpus=None):
+        batches.append([ p["profile"] for p in prepared ])
+        return [ {"key" : key} for key in keys ]
+
+    async def run():
+        monkeypatch.setattr(simcdaemon, 'sim', fake)
+        monkeypatch.setattr(simcdaemon, 'prefetch_semaphore', asyncio.Semaphore(1))
+        monkeypatch.setattr(simcdaemon, 'scheduler', CpuScheduler([0, 1], 1))
+        monkeypatch.setattr(simcdaemon, 'batcher', SimcBatcher(0.05, 10))
+        monkeypatch.setattr(simcdaemon, 'do_simc_work', do_simc_work)
+        return await asyncio.wait_for(asyncio.gather(
+            simcdaemon.simc_request(b'{"character":"vengel"}', 'a', None),
+            simcdaemon.simc_request(b'{"character":"cached"}', 'b', None),
+            simcdaemon.simc_request(b'{"character":"tlexii"}', 'c', None)), 1)
+
+    assert asyncio.run(run()) == [ {"key" : 'a'}, {"dps" : 1}, {"key" : 'c'} ]
+    assert batches == [ [ 'profile.simc', 'profile.simc' ] ]
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from simcresult import SimcReport
+
+
+PLAYER = {
+    "name" : "vengel",
+    "race" : "night_elf",
+    "specialization" : "Protection Warrior",
+    "level" : 60,
+    "role" : "tank",
+    "collected_data" : { "dps" : { "mean" : 6559.981, "mean_std_dev" : 2.5, "min" : 5000.4, "max" : 8000.6 } },
+    "scale_factors" : { "Str" : 9.851, "Crit" : 0, "Haste" : 3.163 },
+    "scale_factors_error" : { "Str" : 0.17 },
+    "stats" : [
+        { "name" : "shield_slam", "portion_amount" : 0.25 },
+        { "name" : "devastate", "portion_amount" : 0.5 },
+        { "portion_amount" : 0.1 },
+    ],
+}
+
+
+@pytest.fixture
+def report(tmp_path):
+    path = tmp_path / 'report.json'
+    path.write_text(json.dumps({ "sim" : { "players" : [ PLAYER, { "name" : "other" } ] } }))
+    return SimcReport(str(path))
+
+
+def test_split_specialization(report):
+    assert report.split_specialization('Protection Warrior') == ('Protection', 'Warrior')
+    assert report.split_specialization('Unholy Death Knight') == ('Unholy', 'Death Knight')
+    assert report.split_specialization('Beast Mastery Hunter') == ('Beast Mastery', 'Hunter')
+    assert report.split_specialization('Unknown') == ('Unknown', '')
+
+
+def test_parse_player(report):
+    record = report.parse_player(PLAYER)
+    assert record.name == 'vengel'
+    assert record.class_name == 'Warrior'
+    assert record.spec == 'Protection'
+    assert record.dps == 6559.981
+    assert record.dps_error == pytest.approx(2.5 * SimcReport.CONFIDENCE)
+    assert record.weights == (('Str', 9.851), ('Haste', 3.163))
+    assert record.weight_errors == (('Str', 0.17),)
+    assert record.abilities == ()
+
+
+def test_parse_player_details(report):
+    record = report.parse_player(PLAYER, details=True)
+    assert record.abilities == (('devastate', 0.5), ('shield_slam', 0.25))
+
+
+def test_parse_player_missing_fields(report):
+    record = report.parse_player({})
+    assert record.name == ''
+    assert record.dps == 0
+    assert record.weights == ()
+
+
+def test_players(report):
+    assert [ p.name for p in report.players() ] == [ 'vengel', 'other' ]
+
+
+def test_to_params(report):
+    record = report.parse_player(PLAYER, details=True)
+    assert SimcReport.to_params(record) == {
+        "output_character" : "Vengel",
+        "output_race" : "Night elf",
+        "output_class" : "Warrior",
+        "output_spec" : "Protection",
+        "dps" : "6559.98",
+        "weights" : "Str=9.85 Haste=3.16",
+    }
+    params = SimcReport.to_params(record, None)
+    assert params["dps_error"] == "4.90"
+    assert params["dps_range"] == "5000-8001"
+    assert params["abilities"] == [ ['devastate', 0.5], ['shield_slam', 0.25] ]